@@ -0,0 +1,65 @@
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram.types import CallbackQuery
+
+from metrics import set_label
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[..., Awaitable[Any]]
+
+
+class CallbackRouter:
+    """
+    Таблица маршрутов для callback_data вида «действие_арг1_арг2» (например, bq_add_5_10).
+    Действие ищется в словаре, а аргументы один раз приводятся к объявленным типам,
+    поэтому стоимость разбора не зависит от числа зарегистрированных действий.
+    Формат callback_data тот же, что и раньше — кнопки в старых сообщениях продолжают работать.
+    """
+
+    def __init__(self, sep: str = "_"):
+        self.sep = sep
+        # имя действия -> (типы аргументов, обработчик)
+        self._routes: Dict[str, Tuple[Tuple[type, ...], Handler]] = {}
+        # Сколько слов максимум в имени действия (remove_from_view — 3)
+        self._max_words = 1
+
+    def route(self, name: str, *arg_types: type) -> Callable[[Handler], Handler]:
+        """Регистрирует обработчик: handler(call, state, *args)."""
+        def decorator(handler: Handler) -> Handler:
+            if name in self._routes:
+                raise ValueError(f"Callback action {name!r} is already registered")
+            self._routes[name] = (arg_types, handler)
+            self._max_words = max(self._max_words, len(name.split(self.sep)))
+            return handler
+        return decorator
+
+    def resolve(self, data: str) -> Optional[Tuple[Handler, Tuple[Any, ...]]]:
+        """Находит обработчик и разобранные аргументы. None — действие неизвестно или аргументы битые."""
+        parts = data.split(self.sep)
+        for words in range(1, min(self._max_words, len(parts)) + 1):
+            entry = self._routes.get(self.sep.join(parts[:words]))
+            if entry is None:
+                continue
+            arg_types, handler = entry
+            if len(arg_types) != len(parts) - words:
+                continue
+            try:
+                args = tuple(t(value) for t, value in zip(arg_types, parts[words:]))
+            except ValueError:
+                logger.warning(f"Bad callback payload: {data!r}")
+                return None
+            return handler, args
+        return None
+
+    async def dispatch(self, call: CallbackQuery, *context: Any) -> bool:
+        """Вызывает обработчик. False — ничего не нашлось (вызывающий сам ответит на callback)."""
+        resolved = self.resolve(call.data or "")
+        if resolved is None:
+            return False
+        handler, args = resolved
+        # В метриках видно конкретное действие, а не общий generic_callback
+        set_label(handler=handler.__name__)
+        await handler(call, *context, *args)
+        return True
@@ -0,0 +1,124 @@
+import itertools
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple
+
+from aiogram.types import InlineKeyboardMarkup
+
+# Для скольких пользователей держим версию корзины, готовый рендер и итоги
+CART_CACHE_SIZE = int(os.getenv("CART_CACHE_SIZE", "10000"))
+
+# (текст в HTML, клавиатура)
+RenderedCart = Tuple[str, InlineKeyboardMarkup]
+# (штук в корзине, сумма)
+CartSummary = Tuple[int, int]
+
+
+class CartChange:
+    """Что изменение сделало с итогами корзины. Если итоги не указаны — их перечитают из БД."""
+
+    def __init__(self):
+        self.delta: Optional[CartSummary] = None
+        self.summary: Optional[CartSummary] = None
+
+    def add(self, count: int, amount: int):
+        count_delta, amount_delta = self.delta or (0, 0)
+        self.delta = (count_delta + count, amount_delta + amount)
+
+    def set(self, count: int, amount: int):
+        self.summary = (count, amount)
+
+
+class CartViews:
+    """
+    Версии корзин, кэш их отрисовки и итоги (количество и сумма).
+    Любое изменение корзины оборачивается в change(): версия меняется, старый рендер выбрасывается,
+    а итоги сдвигаются на известную дельту — пересчитывать всю корзину не нужно.
+    Пока корзина не менялась, повторный просмотр отдает готовые текст и клавиатуру без запросов к БД.
+    Версии берутся из общего счетчика и только растут, поэтому забытый (вытесненный) пользователь
+    не может «вернуться» к старой версии и получить чужой устаревший рендер.
+    """
+
+    def __init__(self, max_users: int = CART_CACHE_SIZE):
+        self.max_users = max_users
+        self._counter = itertools.count(1)
+        # user_id -> [версия, ключ рендера, рендер, итоги]
+        self._entries: "OrderedDict[int, List]" = OrderedDict()
+        # Сколько изменений корзины сейчас в процессе: их результат уже может быть виден в БД
+        self._pending: Dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, user_id: int) -> int:
+        entry = self._entries.get(user_id)
+        return entry[0] if entry else 0
+
+    def _stable(self, user_id: int, version: int) -> bool:
+        """Можно ли кэшировать прочитанное: корзина не менялась и не меняется прямо сейчас."""
+        return self.version(user_id) == version and not self._pending.get(user_id)
+
+    @contextmanager
+    def change(self, user_id: int) -> Iterator[CartChange]:
+        """
+        Оборачивает запись в cart этого пользователя (до BEGIN и после COMMIT).
+        Пока запись идет, прочитанное из БД не кэшируется — иначе дельта применится дважды.
+        """
+        change = CartChange()
+        self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        try:
+            yield change
+        except BaseException:
+            # Не знаем, что успело примениться, — итоги перечитаем
+            change.delta = change.summary = None
+            raise
+        finally:
+            if self._pending[user_id] == 1:
+                del self._pending[user_id]
+            else:
+                self._pending[user_id] -= 1
+
+            entry = self._entries.get(user_id)
+            summary = change.summary
+            if summary is None and change.delta is not None and entry and entry[3] is not None:
+                summary = (entry[3][0] + change.delta[0], entry[3][1] + change.delta[1])
+            self._entries[user_id] = [next(self._counter), None, None, summary]
+            self._touch(user_id)
+
+    # --------- Рендер ---------
+    def get(self, user_id: int, key: Hashable) -> Optional[RenderedCart]:
+        entry = self._entries.get(user_id)
+        if entry and entry[2] is not None and entry[1] == key:
+            self.hits += 1
+            self._entries.move_to_end(user_id)
+            return entry[2]
+        self.misses += 1
+        return None
+
+    def put(self, user_id: int, version: int, key: Hashable, rendered: RenderedCart):
+        """Сохраняет рендер, только если корзина не менялась, пока мы его строили."""
+        if not self._stable(user_id, version):
+            return
+        entry = self._entries.get(user_id)
+        self._entries[user_id] = [version, key, rendered, entry[3] if entry else None]
+        self._touch(user_id)
+
+    # --------- Итоги ---------
+    def summary(self, user_id: int) -> Optional[CartSummary]:
+        entry = self._entries.get(user_id)
+        return entry[3] if entry else None
+
+    def put_summary(self, user_id: int, version: int, summary: CartSummary):
+        if not self._stable(user_id, version):
+            return
+        entry = self._entries.get(user_id)
+        if entry:
+            entry[3] = summary
+        else:
+            self._entries[user_id] = [version, None, None, summary]
+        self._touch(user_id)
+
+    def _touch(self, user_id: int):
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
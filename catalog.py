@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Optional, Tuple
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Типы товаров витрины. Собранные пользователями букеты (created_bouquet) в кэш не попадают
+CATALOG_TYPES = ("bouquet", "lonely")
+
+# (id, name, price, description, type, image)
+Product = Tuple[int, str, int, Optional[str], str, Optional[str]]
+
+
+class Page:
+    """
+    Страница товаров одного типа по ключу (keyset): товары с id > after, по возрастанию id.
+    prev / next — курсоры соседних страниц (None — страницы нет), number и total — для подписи «2 из 5».
+    """
+
+    __slots__ = ("after", "items", "prev", "next", "number", "total")
+
+    def __init__(self, after: int, items: List[Product], prev: Optional[int], next: Optional[int],
+                 number: int, total: int):
+        self.after = after
+        self.items = items
+        self.prev = prev
+        self.next = next
+        self.number = number
+        self.total = total
+
+
+class Catalog:
+    """
+    Кэш каталога в памяти процесса, разбитый по типам товаров.
+    version растет при каждой инвалидации — по нему кэшируются производные данные (клавиатуры и т.п.).
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+        self.version = 0
+        self._by_type: Dict[str, List[Product]] = {t: [] for t in CATALOG_TYPES}
+        self._by_id: Dict[int, Product] = {}
+        # Отсортированные id по типам — для постраничной навигации
+        self._ids_by_type: Dict[str, List[int]] = {t: [] for t in CATALOG_TYPES}
+        # Telegram file_id загруженных фото: product_id -> file_id
+        self._file_ids: Dict[int, str] = {}
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    async def _load(self):
+        version = self.version
+        placeholders = ", ".join("?" for _ in CATALOG_TYPES)
+        rows = await self.db.fetchall(
+            f"SELECT id, name, price, description, type, image, image_file_id FROM products "
+            f"WHERE type IN ({placeholders}) ORDER BY id",
+            CATALOG_TYPES
+        )
+        by_type: Dict[str, List[Product]] = {t: [] for t in CATALOG_TYPES}
+        by_id: Dict[int, Product] = {}
+        file_ids: Dict[int, str] = {}
+        for row in rows:
+            product = tuple(row[:6])
+            by_type[row[4]].append(product)
+            by_id[row[0]] = product
+            if row[6]:
+                file_ids[row[0]] = row[6]
+        self._by_type = by_type
+        self._by_id = by_id
+        self._ids_by_type = {t: [p[0] for p in items] for t, items in by_type.items()}
+        self._file_ids = file_ids
+        # Если во время чтения каталог успели инвалидировать — перечитаем при следующем обращении
+        self._loaded = version == self.version
+        logger.info(f"Catalog loaded: {len(rows)} products, version {version}")
+
+    async def _ensure_loaded(self):
+        if self._loaded:
+            return
+        async with self._lock:
+            if not self._loaded:
+                await self._load()
+
+    def invalidate(self):
+        """Вызывать после любой записи в products с типом из CATALOG_TYPES."""
+        self.version += 1
+        self._loaded = False
+
+    async def products(self, product_type: str) -> List[Product]:
+        await self._ensure_loaded()
+        return self._by_type.get(product_type, [])
+
+    async def get(self, product_id: int) -> Optional[Product]:
+        await self._ensure_loaded()
+        return self._by_id.get(product_id)
+
+    async def all(self) -> List[Product]:
+        await self._ensure_loaded()
+        return list(self._by_id.values())
+
+    # --------- Страницы ---------
+    async def page(self, product_type: str, after: int = 0, size: int = 10) -> Page:
+        """
+        Страница по курсору: товары с id > after (как WHERE type = ? AND id > ? ORDER BY id LIMIT ?,
+        только по кэшу). Курсор — id, а не смещение: если товар добавят или удалят, пока открыто меню,
+        кнопки «вперед/назад» не пропустят и не повторят соседние товары.
+        """
+        products = await self.products(product_type)
+        ids = self._ids_by_type.get(product_type, [])
+        start = bisect_right(ids, after)
+        items = products[start:start + size]
+        next_cursor = items[-1][0] if start + size < len(ids) else None
+        prev_cursor = None
+        if start > 0:
+            # Предыдущая страница выравнивается по сетке size — так же, как страницы при листании с начала
+            prev_start = (start - 1) // size * size
+            prev_cursor = ids[prev_start - 1] if prev_start else 0
+        total = max(1, -(-len(ids) // size))
+        return Page(after, items, prev_cursor, next_cursor, min(start // size + 1, total), total)
+
+    async def page_cursor(self, product_type: str, product_id: int, size: int = 10) -> int:
+        """Курсор страницы, на которой находится товар (чтобы после нажатия остаться на ней)."""
+        await self._ensure_loaded()
+        ids = self._ids_by_type.get(product_type, [])
+        start = bisect_left(ids, product_id) // size * size
+        return ids[start - 1] if start else 0
+
+    # --------- file_id фото ---------
+    def file_id(self, product_id: int) -> Optional[str]:
+        return self._file_ids.get(product_id)
+
+    async def remember_file_id(self, product_id: int, file_id: Optional[str]):
+        """
+        Сохраняет file_id фото (None — сбросить, например если Telegram его больше не принимает).
+        Клавиатуры от фото не зависят, поэтому версия каталога не меняется.
+        """
+        if file_id:
+            self._file_ids[product_id] = file_id
+        else:
+            self._file_ids.pop(product_id, None)
+        await self.db.execute("UPDATE products SET image_file_id = ? WHERE id = ?", (file_id, product_id))
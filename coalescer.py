@@ -0,0 +1,65 @@
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, Hashable
+
+from aiogram.exceptions import TelegramBadRequest
+
+logger = logging.getLogger(__name__)
+
+# Минимальный интервал между правками одного сообщения (сек)
+EDIT_COALESCE_WINDOW = float(os.getenv("EDIT_COALESCE_WINDOW", "0.5"))
+
+Render = Callable[[], Awaitable[None]]
+
+
+class EditCoalescer:
+    """
+    Схлопывает частые правки одного сообщения.
+    Первая правка уходит сразу, все последующие в пределах окна заменяют друг друга,
+    и по истечении окна отправляется только последняя. Рендер вызывается лениво —
+    текст собирается один раз на отправку, а не на каждое нажатие.
+    """
+
+    def __init__(self, window: float = EDIT_COALESCE_WINDOW):
+        self.window = window
+        self._pending: Dict[Hashable, Render] = {}
+        self._workers: Dict[Hashable, asyncio.Task] = {}
+        self.requested = 0
+        self.sent = 0
+
+    @property
+    def saved(self) -> int:
+        """Сколько правок не пришлось отправлять."""
+        return self.requested - self.sent - len(self._pending)
+
+    def submit(self, key: Hashable, render: Render):
+        """key — обычно (chat_id, message_id); render — корутина, которая делает саму правку."""
+        self.requested += 1
+        self._pending[key] = render
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._worker(key))
+
+    async def _worker(self, key: Hashable):
+        try:
+            while True:
+                render = self._pending.pop(key, None)
+                if render is None:
+                    return
+                self.sent += 1
+                try:
+                    await render()
+                except TelegramBadRequest as e:
+                    # "message is not modified" и т.п. — не критично
+                    logger.debug(f"Coalesced edit skipped: {e}")
+                except Exception as e:
+                    logger.error(f"Coalesced edit error: {e}")
+                await asyncio.sleep(self.window)
+        finally:
+            self._workers.pop(key, None)
+
+    async def stop(self):
+        """Дожидается отправки всех отложенных правок."""
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+        logger.info(f"Edits: {self.requested} requested, {self.sent} sent, {self.saved} saved")
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import os
+from typing import List, Optional, Tuple
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+COMPACTION_INTERVAL = float(os.getenv("COMPACTION_INTERVAL", "3600"))
+COMPACTION_BATCH = int(os.getenv("COMPACTION_BATCH", "500"))
+
+# Таблицы, которые ссылаются на собранные букеты: пока ссылка есть, букет удалять нельзя
+BOUQUET_REFERENCES: List[Tuple[str, str]] = [
+    ("cart", "product_id"),
+    ("order_items", "product_id"),
+]
+
+
+class BouquetCompactor:
+    """
+    Фоновая сборка мусора: удаляет собранные букеты (type = created_bouquet),
+    на которые больше никто не ссылается (их убрали из корзины, заменили при редактировании и т.п.).
+    """
+
+    def __init__(self, db: Database, interval: float = COMPACTION_INTERVAL, batch_size: int = COMPACTION_BATCH):
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.reclaimed = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def _orphans_sql(self) -> str:
+        not_referenced = " AND ".join(
+            f"NOT EXISTS (SELECT 1 FROM {table} r WHERE r.{column} = p.id)"
+            for table, column in BOUQUET_REFERENCES
+        )
+        return f"SELECT p.id FROM products p WHERE p.type = 'created_bouquet' AND {not_referenced} LIMIT ?"
+
+    async def compact_batch(self) -> int:
+        """Удаляет одну пачку сирот в отдельной транзакции. Возвращает число удаленных букетов."""
+        async with self.db.transaction() as conn:
+            # Выбор и удаление — в одной транзакции, поэтому букет не может «ожить» между ними
+            cur = await conn.execute(
+                f"DELETE FROM products WHERE id IN ({self._orphans_sql()}) RETURNING id", (self.batch_size,)
+            )
+            ids = [row[0] for row in await cur.fetchall()]
+            await cur.close()
+            if ids:
+                await conn.executemany("DELETE FROM bouquet_items WHERE bouquet_id = ?", [(i,) for i in ids])
+        return len(ids)
+
+    async def compact(self) -> int:
+        """Удаляет всех сирот пачками. Между пачками отдаем писателя другим запросам."""
+        total = 0
+        while True:
+            deleted = await self.compact_batch()
+            total += deleted
+            if deleted < self.batch_size:
+                break
+            await asyncio.sleep(0)
+        self.reclaimed += total
+        if total:
+            logger.info(f"Compaction: reclaimed {total} created_bouquet rows")
+        return total
+
+    async def _run(self):
+        while True:
+            try:
+                await self.compact()
+            except Exception as e:
+                logger.error(f"Compaction error: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,270 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+# Настройки соединений (можно переопределить через .env)
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16000"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_STATEMENT_CACHE = 256
+# Выражения дольше этого порога (мс) пишутся в лог вместе с EXPLAIN QUERY PLAN; пусто — не логировать
+DB_SLOW_QUERY_MS = os.getenv("DB_SLOW_QUERY_MS", "50")
+
+# Метка для SQL вне обработки обновлений (фоновые задачи, старт)
+BACKGROUND_TAG = "background"
+
+
+class QueryScope:
+    """SQL одного обновления: сколько выражений и сколько времени в БД. tag — имя обработчика."""
+
+    __slots__ = ("tag", "statements", "seconds", "closed")
+
+    def __init__(self, tag: str):
+        self.tag = tag
+        self.statements = 0
+        self.seconds = 0.0
+        self.closed = False
+
+
+_query_scope: ContextVar[Optional[QueryScope]] = ContextVar("query_scope", default=None)
+
+
+def tag_queries(tag: str):
+    """Переименовать текущую область (обработчик стал известен уже после начала обновления)."""
+    scope = _query_scope.get()
+    if scope is not None:
+        scope.tag = tag
+
+
+class _TrackedConnection:
+    """Соединение-писатель внутри транзакции: каждое выражение учитывается в статистике."""
+
+    def __init__(self, db: "Database", conn: aiosqlite.Connection):
+        self._db = db
+        self._conn = conn
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()) -> aiosqlite.Cursor:
+        started = time.perf_counter()
+        cur = await self._conn.execute(sql, params)
+        self._db._account(sql, params, time.perf_counter() - started)
+        return cur
+
+    async def executemany(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> aiosqlite.Cursor:
+        seq_of_params = list(seq_of_params)
+        started = time.perf_counter()
+        cur = await self._conn.executemany(sql, seq_of_params)
+        self._db._account(sql, seq_of_params[0] if seq_of_params else (), time.perf_counter() - started)
+        return cur
+
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+
+
+class Database:
+    """
+    Долгоживущий пул соединений с SQLite.
+    Один писатель (запись строго последовательно под asyncio.Lock) и несколько читателей:
+    в режиме WAL чтения не блокируются записью.
+    Каждое выражение учитывается: в области текущего обновления (scope) и в сводке по обработчикам,
+    медленные пишутся в лог с планом запроса.
+    """
+
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self.readers_count = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._readers: "asyncio.Queue[aiosqlite.Connection]" = asyncio.Queue()
+        self._all_readers: List[aiosqlite.Connection] = []
+        self._write_lock = asyncio.Lock()
+        self.slow_query_seconds = float(DB_SLOW_QUERY_MS) / 1000 if DB_SLOW_QUERY_MS else None
+        # Всего выполненных SQL-выражений (без служебных BEGIN/COMMIT и PRAGMA)
+        self.statements = 0
+        self.slow_statements = 0
+        # обработчик -> [обновлений, выражений, секунд в БД, максимум выражений за обновление]
+        self.by_tag: Dict[str, List] = {}
+        # Для каких запросов план уже выводился (чтобы не засорять лог)
+        self._explained: set = set()
+
+    # --------- Учет выражений ---------
+    @contextmanager
+    def scope(self, tag: str = "unhandled") -> Iterator[QueryScope]:
+        """Область учета SQL одного обновления (открывается внешним middleware)."""
+        scope = QueryScope(tag)
+        token = _query_scope.set(scope)
+        try:
+            yield scope
+        finally:
+            _query_scope.reset(token)
+            # Задачи, запущенные из обработчика, унаследовали область — после закрытия их SQL идет в фон
+            scope.closed = True
+            totals = self.by_tag.setdefault(scope.tag, [0, 0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += scope.statements
+            totals[2] += scope.seconds
+            totals[3] = max(totals[3], scope.statements)
+
+    def _account(self, sql: str, params: Sequence[Any], elapsed: float):
+        self.statements += 1
+        scope = _query_scope.get()
+        if scope is not None and not scope.closed:
+            scope.statements += 1
+            scope.seconds += elapsed
+            tag = scope.tag
+        else:
+            tag = BACKGROUND_TAG
+            totals = self.by_tag.setdefault(tag, [0, 0, 0.0, 0])
+            totals[1] += 1
+            totals[2] += elapsed
+        if self.slow_query_seconds is not None and elapsed >= self.slow_query_seconds:
+            self._report_slow(sql, params, elapsed, tag)
+
+    def _report_slow(self, sql: str, params: Sequence[Any], elapsed: float, tag: str):
+        self.slow_statements += 1
+        statement = " ".join(sql.split())
+        # Значения параметров не пишем: там адреса, время доставки, данные FSM и платежей
+        logger.warning(f"Slow SQL in {tag}: {elapsed * 1000:.1f} ms: {statement} ({len(params)} params)")
+        if statement in self._explained or len(self._explained) >= 1000 or not self._all_readers:
+            return
+        self._explained.add(statement)
+        # План берем на читателе в отдельной задаче: вызывающий мог держать писателя внутри транзакции
+        asyncio.create_task(self._explain(statement, params))
+
+    async def _explain(self, sql: str, params: Sequence[Any]):
+        try:
+            async with self.read() as conn:
+                cur = await conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+                rows = await cur.fetchall()
+                await cur.close()
+        except Exception as e:
+            logger.warning(f"EXPLAIN QUERY PLAN failed for {sql}: {e}")
+            return
+        # Строки плана: (id, parent, notused, detail) — отступ по глубине вложенности
+        depth = {0: 0}
+        lines = []
+        for node_id, parent, _, detail in rows:
+            depth[node_id] = depth.get(parent, 0) + 1
+            lines.append("  " * depth[node_id] + detail)
+        logger.warning(f"Query plan for {sql}:\n" + "\n".join(lines))
+
+    def summary(self) -> List[str]:
+        """Сводка по обработчикам: строки для лога, самые «дорогие» по времени в БД — первыми."""
+        lines = [f"{'handler':<28}{'updates':>9}{'sql':>9}{'sql/upd':>9}{'max':>6}{'db ms':>11}{'ms/upd':>9}"]
+        for tag, (updates, statements, seconds, peak) in sorted(
+                self.by_tag.items(), key=lambda item: item[1][2], reverse=True):
+            per_update = f"{statements / updates:>9.1f}" if updates else f"{'-':>9}"
+            ms_per_update = f"{seconds * 1000 / updates:>9.2f}" if updates else f"{'-':>9}"
+            lines.append(f"{tag:<28}{updates:>9}{statements:>9}{per_update}{peak:>6}"
+                         f"{seconds * 1000:>11.1f}{ms_per_update}")
+        return lines
+
+    async def _open(self) -> aiosqlite.Connection:
+        # isolation_level=None — транзакции открываем сами (BEGIN IMMEDIATE),
+        # cached_statements — повторное использование подготовленных запросов
+        conn = await aiosqlite.connect(self.path, isolation_level=None, cached_statements=DB_STATEMENT_CACHE)
+        await conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        await conn.execute("PRAGMA synchronous = NORMAL")
+        await conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        await conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        await conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    async def connect(self):
+        if self._writer is not None:
+            return
+        self._writer = await self._open()
+        cur = await self._writer.execute("PRAGMA journal_mode = WAL")
+        mode = await cur.fetchone()
+        logger.info(f"SQLite journal_mode={mode[0] if mode else '?'}")
+
+        for _ in range(self.readers_count):
+            conn = await self._open()
+            await conn.execute("PRAGMA query_only = ON")
+            self._all_readers.append(conn)
+            self._readers.put_nowait(conn)
+
+    async def close(self):
+        if self.by_tag:
+            logger.info("SQL by handler:\n" + "\n".join(self.summary()))
+        for conn in self._all_readers:
+            await conn.close()
+        self._all_readers.clear()
+        self._readers = asyncio.Queue()
+        if self._writer is not None:
+            # Сбрасываем WAL в основной файл перед выходом
+            try:
+                await self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except Exception as e:
+                logger.error(f"WAL checkpoint error: {e}")
+            await self._writer.close()
+            self._writer = None
+
+    # --------- Чтение ---------
+    @asynccontextmanager
+    async def read(self) -> AsyncIterator[aiosqlite.Connection]:
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    async def fetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+        async with self.read() as conn:
+            started = time.perf_counter()
+            cur = await conn.execute(sql, params)
+            row = await cur.fetchone()
+            await cur.close()
+        self._account(sql, params, time.perf_counter() - started)
+        return row
+
+    async def fetchall(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        async with self.read() as conn:
+            started = time.perf_counter()
+            cur = await conn.execute(sql, params)
+            rows = await cur.fetchall()
+            await cur.close()
+        self._account(sql, params, time.perf_counter() - started)
+        return list(rows)
+
+    # --------- Запись ---------
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Транзакция на соединении-писателе. COMMIT при успехе, ROLLBACK при ошибке."""
+        async with self._write_lock:
+            conn = self._writer
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield _TrackedConnection(self, conn)
+            except BaseException:
+                await conn.rollback()
+                raise
+            else:
+                await conn.commit()
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        """Одиночная запись в своей транзакции. Возвращает число затронутых строк."""
+        async with self.transaction() as conn:
+            cur = await conn.execute(sql, params)
+            rowcount = cur.rowcount
+            await cur.close()
+            return rowcount
+
+    async def execute_fetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+        """Одиночная запись с RETURNING: один запрос, результат — первая возвращенная строка."""
+        async with self.transaction() as conn:
+            cur = await conn.execute(sql, params)
+            row = await cur.fetchone()
+            await cur.close()
+            return row
+
+    async def executemany(self, sql: str, seq_of_params: Iterable[Sequence[Any]]):
+        async with self.transaction() as conn:
+            await conn.executemany(sql, seq_of_params)
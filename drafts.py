@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Iterable, Optional, Set
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Через сколько секунд после последнего нажатия черновик записывается в БД
+DRAFT_FLUSH_DELAY = float(os.getenv("DRAFT_FLUSH_DELAY", "3"))
+# Как часто фоновая задача проверяет, что пора записать
+DRAFT_FLUSH_INTERVAL = float(os.getenv("DRAFT_FLUSH_INTERVAL", "1"))
+# Через сколько секунд бездействия черновик выгружается из памяти
+DRAFT_IDLE_TIMEOUT = float(os.getenv("DRAFT_IDLE_TIMEOUT", "900"))
+
+
+class DraftStore:
+    """
+    Черновики конструктора букетов в памяти: user_id -> {product_id: quantity}.
+    Пока конструктор открыт, источник истины — память; таблица bouquet_draft
+    обновляется фоновой задачей пачками (write-behind) и при остановке бота.
+    """
+
+    def __init__(self, db: Database, flush_delay: float = DRAFT_FLUSH_DELAY,
+                 flush_interval: float = DRAFT_FLUSH_INTERVAL, idle_timeout: float = DRAFT_IDLE_TIMEOUT):
+        self.db = db
+        self.flush_delay = flush_delay
+        self.flush_interval = flush_interval
+        self.idle_timeout = idle_timeout
+        self._drafts: Dict[int, Dict[int, int]] = {}
+        self._dirty: Set[int] = set()
+        self._touched: Dict[int, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.rows_written = 0
+
+    # --------- Чтение / изменение ---------
+    async def items(self, user_id: int) -> Dict[int, int]:
+        """Текущий черновик. При первом обращении подгружается из БД."""
+        draft = self._drafts.get(user_id)
+        if draft is None:
+            rows = await self.db.fetchall(
+                "SELECT product_id, quantity FROM bouquet_draft WHERE user_id = ? ORDER BY rowid", (user_id,)
+            )
+            # setdefault — на случай, если параллельный запрос уже загрузил черновик
+            draft = self._drafts.setdefault(user_id, {pid: qty for pid, qty in rows})
+        self._touched[user_id] = time.monotonic()
+        return draft
+
+    def _mark(self, user_id: int):
+        self._dirty.add(user_id)
+        self._touched[user_id] = time.monotonic()
+
+    async def add(self, user_id: int, product_id: int, delta: int) -> int:
+        """Меняет количество на delta и возвращает новое (0 — цветок убран из букета)."""
+        draft = await self.items(user_id)
+        new_qty = draft.get(product_id, 0) + delta
+        if new_qty <= 0:
+            draft.pop(product_id, None)
+            new_qty = 0
+        else:
+            draft[product_id] = new_qty
+        self._mark(user_id)
+        return new_qty
+
+    async def delete(self, user_id: int, product_id: int):
+        draft = await self.items(user_id)
+        draft.pop(product_id, None)
+        self._mark(user_id)
+
+    def clear(self, user_id: int):
+        self._drafts[user_id] = {}
+        self._mark(user_id)
+
+    def replace(self, user_id: int, items: Dict[int, int]):
+        self._drafts[user_id] = dict(items)
+        self._mark(user_id)
+
+    def forget(self, user_id: int):
+        """
+        Убирает черновик из памяти без записи.
+        Вызывать, когда вызывающий код сам удалил строки bouquet_draft в своей транзакции.
+        """
+        self._drafts.pop(user_id, None)
+        self._dirty.discard(user_id)
+        self._touched.pop(user_id, None)
+
+    # --------- Запись в БД ---------
+    async def flush(self, user_ids: Optional[Iterable[int]] = None) -> int:
+        """Пачкой записывает измененные черновики. Возвращает число записанных пользователей."""
+        candidates = list(self._dirty if user_ids is None else user_ids)
+        if not candidates:
+            return 0
+
+        async with self.db.transaction() as conn:
+            # Снимок берем уже под блокировкой записи, чтобы не перетереть чужую транзакцию старыми данными
+            users = [u for u in candidates if u in self._dirty]
+            if not users:
+                return 0
+            rows = [(u, pid, qty) for u in users for pid, qty in self._drafts.get(u, {}).items()]
+            self._dirty.difference_update(users)
+            try:
+                await conn.executemany("DELETE FROM bouquet_draft WHERE user_id = ?", [(u,) for u in users])
+                await conn.executemany(
+                    "INSERT INTO bouquet_draft (user_id, product_id, quantity) VALUES (?, ?, ?)", rows
+                )
+            except BaseException:
+                # Не записали — попробуем в следующий раз
+                self._dirty.update(users)
+                raise
+
+        self.flushes += 1
+        self.rows_written += len(rows)
+        return len(users)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            now = time.monotonic()
+            try:
+                due = [u for u in self._dirty if now - self._touched.get(u, 0) >= self.flush_delay]
+                if due:
+                    await self.flush(due)
+            except Exception as e:
+                logger.error(f"Draft flush error: {e}")
+
+            # Выгружаем из памяти давно не тронутые (и уже записанные) черновики
+            idle = [u for u, t in self._touched.items()
+                    if now - t >= self.idle_timeout and u not in self._dirty]
+            for u in idle:
+                self.forget(u)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        logger.info(f"Drafts: {self.flushes} flushes, {self.rows_written} rows written")
@@ -0,0 +1,118 @@
+import os
+from typing import Dict, Hashable, List, Optional
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from catalog import Catalog, Page
+
+# Товаров на странице витрины и конструктора (у цветка в конструкторе две строки кнопок,
+# а Telegram ограничивает размер клавиатуры)
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", "8"))
+CREATION_PAGE_SIZE = int(os.getenv("CREATION_PAGE_SIZE", "6"))
+
+
+class KeyboardCache:
+    """
+    Готовые InlineKeyboardMarkup, привязанные к версии каталога.
+    При смене версии весь кэш сбрасывается — старые клавиатуры больше не нужны.
+    """
+
+    def __init__(self):
+        self.version: Optional[int] = None
+        self._items: Dict[Hashable, InlineKeyboardMarkup] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, version: int, key: Hashable) -> Optional[InlineKeyboardMarkup]:
+        if version != self.version:
+            return None
+        kb = self._items.get(key)
+        if kb is not None:
+            self.hits += 1
+        return kb
+
+    def put(self, version: int, key: Hashable, kb: InlineKeyboardMarkup):
+        self.misses += 1
+        if version != self.version:
+            self._items.clear()
+            self.version = version
+        self._items[key] = kb
+
+
+kb_cache = KeyboardCache()
+
+
+# --------- Сборка клавиатур ---------
+def build_page_nav(page: Page, action: str) -> List[InlineKeyboardButton]:
+    """Строка «◀️ 2/5 ▶️»; callback_data — {action}_{курсор}. Пустая, если страница одна."""
+    if page.prev is None and page.next is None:
+        return []
+    row = []
+    if page.prev is not None:
+        row.append(InlineKeyboardButton(text="◀️", callback_data=f"{action}_{page.prev}"))
+    row.append(InlineKeyboardButton(text=f"{page.number}/{page.total}", callback_data="noop"))
+    if page.next is not None:
+        row.append(InlineKeyboardButton(text="▶️", callback_data=f"{action}_{page.next}"))
+    return row
+
+
+def build_main_menu_kb(page: Page) -> InlineKeyboardMarkup:
+    kb = []
+    # Кнопки ведут на просмотр (view_product_)
+    for pid, name, price, *_ in page.items:
+        kb.append([InlineKeyboardButton(text=f"👁 {name} — {price} ₽", callback_data=f"view_product_{pid}")])
+
+    nav = build_page_nav(page, "menu_page")
+    if nav:
+        kb.append(nav)
+    kb.append([InlineKeyboardButton(text="🌸 Создать свой букет", callback_data="create_bouquet")])
+    kb.append([InlineKeyboardButton(text="🧺 Перейти в корзину", callback_data="view_cart")])
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+
+def build_creation_kb(page: Page, editing: bool) -> InlineKeyboardMarkup:
+    kb = []
+    for pid, name, price, *_ in page.items:
+        kb.append([InlineKeyboardButton(text=f"🔍 {name} — {price} ₽", callback_data=f"view_flower_{pid}")])
+
+        kb.append([
+            InlineKeyboardButton(text="+1", callback_data=f"bq_add_{pid}_1"),
+            InlineKeyboardButton(text="+10", callback_data=f"bq_add_{pid}_10"),
+            InlineKeyboardButton(text="-1", callback_data=f"bq_sub_{pid}_1"),
+            InlineKeyboardButton(text="🗑", callback_data=f"bq_del_{pid}")
+        ])
+
+    nav = build_page_nav(page, "bq_page")
+    if nav:
+        kb.append(nav)
+    kb.append([InlineKeyboardButton(text="🎁 Упаковать (+15₽) и в корзину", callback_data="pack_yes"),
+               InlineKeyboardButton(text="🚫 В корзину без упаковки", callback_data="pack_no")])
+    kb.append([InlineKeyboardButton(text="🧹 Сбросить всё", callback_data="reset_draft")])
+
+    # Кнопка назад / сохранить
+    if editing:
+        kb.append([InlineKeyboardButton(text="💾 Сохранить и выйти", callback_data="back_from_creation")])
+    else:
+        kb.append([InlineKeyboardButton(text="🔙 Назад (без сохранения)", callback_data="back_from_creation")])
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+
+# --------- Кэшированные клавиатуры (по странице) ---------
+async def main_menu_kb(catalog: Catalog, after: int = 0) -> InlineKeyboardMarkup:
+    page = await catalog.page("bouquet", after, CATALOG_PAGE_SIZE)
+    key = ("main_menu", after)
+    kb = kb_cache.get(catalog.version, key)
+    if kb is None:
+        kb = build_main_menu_kb(page)
+        kb_cache.put(catalog.version, key, kb)
+    return kb
+
+
+async def creation_kb(catalog: Catalog, editing: bool, after: int = 0) -> InlineKeyboardMarkup:
+    page = await catalog.page("lonely", after, CREATION_PAGE_SIZE)
+    key = ("creation", editing, after)
+    kb = kb_cache.get(catalog.version, key)
+    if kb is None:
+        kb = build_creation_kb(page, editing)
+        kb_cache.put(catalog.version, key, kb)
+    return kb
@@ -0,0 +1,240 @@
+"""
+Нагрузочный прогон бота без Telegram.
+
+Синтетические пользователи проходят типичный путь покупателя (/start → карточка букета → в корзину →
+конструктор → N раз «+1 цветок» → упаковка → оформление → адрес → время → оплата на месте).
+Обновления подаются прямо в dp.feed_update, а вместо HTTP-сессии бота стоит заглушка,
+которая записывает вызовы API и сразу отвечает (можно добавить искусственную задержку).
+
+Запуск:
+    python loadtest.py --users 50 --journeys 3 --bq-adds 10
+
+В конце печатается пропускная способность, p50/p95/p99 по каждому шагу и число SQL-выражений на обновление.
+База создается во временном каталоге (или --db путь), рабочая flower_shop.db не трогается.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import Chat, Message, PhotoSize, Update, User
+
+LOADTEST_USER_BASE = 7_000_000_000
+
+
+class StubSession(BaseSession):
+    """Сессия бота без сети: считает вызовы методов API и возвращает правдоподобные ответы."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1_000_000)
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        returning = str(method.__returning__)
+        if "Message" not in returning:
+            return True
+        chat_id = getattr(method, "chat_id", None) or 0
+        message = Message(
+            message_id=next(self._message_ids),
+            date=datetime.now(),
+            chat=Chat(id=int(chat_id), type="private"),
+            from_user=User(id=bot.id, is_bot=True, first_name="Bot"),
+            text=getattr(method, "text", None),
+            photo=[PhotoSize(file_id=f"stub-{method.photo}", file_unique_id="stub", width=1, height=1)]
+            if getattr(method, "photo", None) else None,
+        )
+        return message.as_(bot)
+
+
+class Journey:
+    """Один синтетический покупатель: строит обновления от его имени."""
+
+    _update_ids = itertools.count(1)
+
+    def __init__(self, bot: Bot, user_id: int):
+        self.bot = bot
+        self.user_id = user_id
+        self.message_id = 1
+
+    def _user(self) -> dict:
+        return {"id": self.user_id, "is_bot": False, "first_name": "Load", "username": f"load{self.user_id}"}
+
+    def _chat(self) -> dict:
+        return {"id": self.user_id, "type": "private"}
+
+    def message(self, text: str) -> Update:
+        self.message_id += 1
+        return Update.model_validate({
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": self.message_id, "date": int(time.time()),
+                "chat": self._chat(), "from": self._user(), "text": text,
+            },
+        }, context={"bot": self.bot})
+
+    def callback(self, data: str) -> Update:
+        update_id = next(self._update_ids)
+        return Update.model_validate({
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id), "from": self._user(), "chat_instance": str(self.user_id), "data": data,
+                "message": {
+                    "message_id": self.message_id, "date": int(time.time()), "chat": self._chat(),
+                    "from": {"id": self.bot.id, "is_bot": True, "first_name": "Bot"}, "text": "…",
+                },
+            },
+        }, context={"bot": self.bot})
+
+
+def journey_steps(bouquet_id: int, flower_ids: List[int], bq_adds: int) -> List[Tuple[str, str, str]]:
+    """Путь покупателя: [(имя шага, тип обновления, данные)]."""
+    steps = [
+        ("start", "message", "/start"),
+        ("view_product", "callback", f"view_product_{bouquet_id}"),
+        ("add_from_view", "callback", f"add_from_view_{bouquet_id}"),
+        ("create_bouquet", "callback", "create_bouquet"),
+    ]
+    for i in range(bq_adds):
+        steps.append(("bq_add", "callback", f"bq_add_{flower_ids[i % len(flower_ids)]}_1"))
+    steps += [
+        ("pack_yes", "callback", "pack_yes"),
+        ("checkout", "callback", "checkout"),
+        ("address", "message", "ул. Нагрузочная, 1"),
+        ("addr_confirm_yes", "callback", "addr_confirm_yes"),
+        ("time", "message", "Завтра к 18:00"),
+        ("pay_onsite", "callback", "pay_onsite"),
+    ]
+    return steps
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+async def run(args):
+    # main читает настройки при импорте — окружение готовим заранее
+    os.environ["DB_PATH"] = args.db
+    os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+    import main
+
+    session = StubSession(latency=args.api_latency / 1000)
+    if args.rate_limit:
+        session.middleware(main.send_scheduler)
+    main.bot.session = session
+
+    await main.db.connect()
+    try:
+        await main.init_db()
+        main.drafts.start()
+        main.fsm_storage.start()
+        main.admin_outbox.start()
+
+        bouquet_id = (await main.catalog.products("bouquet"))[0][0]
+        flower_ids = [p[0] for p in await main.catalog.products("lonely")]
+        steps = journey_steps(bouquet_id, flower_ids, args.bq_adds)
+
+        async def feed(journey: Journey, kind: str, data: str):
+            update = journey.message(data) if kind == "message" else journey.callback(data)
+            await main.dp.feed_update(main.bot, update)
+
+        # Прогрев и калибровка: один покупатель в одиночку — здесь SQL точно относится к своему шагу
+        sql_per_step: Dict[str, List[int]] = defaultdict(list)
+        warmup = Journey(main.bot, LOADTEST_USER_BASE - 1)
+        for name, kind, data in steps:
+            before = main.db.statements
+            await feed(warmup, kind, data)
+            sql_per_step[name].append(main.db.statements - before)
+
+        latencies: Dict[str, List[float]] = defaultdict(list)
+        errors: Counter = Counter()
+
+        async def shopper(index: int):
+            journey = Journey(main.bot, LOADTEST_USER_BASE + index)
+            for _ in range(args.journeys):
+                for name, kind, data in steps:
+                    started = time.perf_counter()
+                    try:
+                        await feed(journey, kind, data)
+                    except Exception:
+                        errors[name] += 1
+                    latencies[name].append(time.perf_counter() - started)
+
+        calls_before = sum(session.calls.values())
+        statements_before = main.db.statements
+        started = time.perf_counter()
+        await asyncio.gather(*(shopper(i) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+        # Досылаем отложенные правки конструктора, чтобы их вызовы API тоже попали в отчет
+        await main.edit_coalescer.stop()
+
+        updates = sum(len(v) for v in latencies.values())
+        statements = main.db.statements - statements_before
+        print(f"\nПокупателей: {args.users}, путей на каждого: {args.journeys}, bq_add за путь: {args.bq_adds}")
+        print(f"Обновлений: {updates} за {elapsed:.2f} с — {updates / elapsed:.1f} обн/с, "
+              f"{args.users * args.journeys / elapsed:.2f} заказов/с")
+        print(f"SQL-выражений на обновление (в среднем под нагрузкой): {statements / max(updates, 1):.1f}")
+        print(f"Вызовов API на обновление: {(sum(session.calls.values()) - calls_before) / max(updates, 1):.2f}\n")
+
+        print(f"{'шаг':<18}{'кол-во':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'SQL':>6}{'ошибок':>8}")
+        for name in dict.fromkeys(name for name, _, _ in steps):
+            values = latencies[name]
+            sql = sql_per_step[name]
+            print(f"{name:<18}{len(values):>8}"
+                  f"{percentile(values, 0.50) * 1000:>10.2f}{percentile(values, 0.95) * 1000:>10.2f}"
+                  f"{percentile(values, 0.99) * 1000:>10.2f}{sum(sql) / len(sql):>6.0f}{errors[name]:>8}")
+
+        print("\nВызовы API:")
+        for method, count in session.calls.most_common():
+            print(f"  {method:<24}{count:>8}")
+
+        print("\nSQL по обработчикам:")
+        for line in main.db.summary():
+            print(f"  {line}")
+    finally:
+        await main.admin_outbox.stop()
+        await main.fsm_storage.stop()
+        await main.drafts.stop()
+        await main.edit_coalescer.stop()
+        await main.send_scheduler.stop()
+        await main.db.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон FlowerShop-Bot без Telegram")
+    parser.add_argument("--users", type=int, default=50, help="одновременных покупателей")
+    parser.add_argument("--journeys", type=int, default=2, help="сколько раз каждый проходит путь до заказа")
+    parser.add_argument("--bq-adds", type=int, default=10, help="нажатий «+1» в конструкторе за путь")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="искусственная задержка API, мс")
+    parser.add_argument("--rate-limit", action="store_true", help="пропускать запросы через SendScheduler")
+    parser.add_argument("--db", default=None, help="путь к базе (по умолчанию — временный файл)")
+    args = parser.parse_args()
+    if args.db is None:
+        args.db = os.path.join(tempfile.mkdtemp(prefix="flowershop-load-"), "loadtest.db")
+    return args
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -3,18 +3,40 @@
 # Установите: pip install aiogram aiosqlite
 
 import asyncio
+import logging
 import os
+from typing import Optional
 
-import aiosqlite
 from aiogram import Bot, Dispatcher, F, types
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice, PreCheckoutQuery
+from aiogram.types import InlineQuery, InlineQueryResultCachedPhoto, InlineQueryResultPhoto
 from datetime import datetime
 import random
 from dotenv import load_dotenv
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.exceptions import TelegramBadRequest
 import aiohttp
 import payment_services
+from database import Database
+from catalog import Catalog
+import keyboards
+from drafts import DraftStore
+from coalescer import EditCoalescer
+import photos
+from compaction import BouquetCompactor
+from webhook import WebhookServer
+from storage import SQLiteStorage, SessionStore
+import orders
+from outbox import AdminOutbox
+import migrations
+from search import CatalogSearch
+from ratelimit import SendScheduler
+from callbacks import CallbackRouter
+from carts import CartViews
+from metrics import (Metrics, MetricsServer, UpdateMetricsMiddleware, HandlerLabelMiddleware,
+                     ApiMetricsMiddleware)
 
 load_dotenv()
 
@@ -23,49 +45,67 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = os.getenv("ADMIN_ID")
 CRYPTOPAY_TOKEN = os.getenv("CRYPTOPAY_TOKEN")
 PORTMONE_TOKEN = os.getenv("PORTMONE_TOKEN")
+# Режим получения обновлений: polling (по умолчанию) или webhook (см. webhook.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Уровень логов (INFO — видны статистика кэшей, очередей и сводка SQL при остановке)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Сколько секунд Telegram может сам кэшировать ответ на inline-запрос
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
 if not BOT_TOKEN: exit("Error: BOT_TOKEN not found in environment variables!")
 # ----------------------------------------------------
 
+logger = logging.getLogger(__name__)
+
 class OrderState(StatesGroup):
     waiting_for_address = State()  # Ждем ввод адреса
     waiting_for_time = State()     # Ждем ввод времени
     waiting_for_payment_type = State()  # <--- Важно!
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-
-DB_PATH = "flower_shop.db"
-
-# --------- SQL и инициализация БД ---------
-CREATE_PRODUCTS_TABLE = """
-CREATE TABLE IF NOT EXISTS products (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    name TEXT NOT NULL UNIQUE,
-    price INTEGER NOT NULL,
-    description TEXT,
-    type TEXT NOT NULL
-);
-"""
-
-CREATE_CART_TABLE = """
-CREATE TABLE IF NOT EXISTS cart (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    product_id INTEGER NOT NULL,
-    quantity INTEGER NOT NULL DEFAULT 1,
-    UNIQUE(user_id, product_id)
-);
-"""
-
-CREATE_DRAFT_TABLE = """
-CREATE TABLE IF NOT EXISTS bouquet_draft (
-    user_id INTEGER NOT NULL,
-    product_id INTEGER NOT NULL,
-    quantity INTEGER NOT NULL DEFAULT 1,
-    UNIQUE(user_id, product_id)
-);
-"""
+DB_PATH = os.getenv("DB_PATH", "flower_shop.db")
+db = Database(DB_PATH)
 
+# FSM и пользовательские сессии хранятся в той же SQLite — рестарт посреди оформления ничего не теряет
+fsm_storage = SQLiteStorage(db)
+bot = Bot(token=BOT_TOKEN)
+# Все исходящие запросы проходят через планировщик: лимиты Telegram (общий и на чат), Retry-After, приоритеты
+send_scheduler = SendScheduler()
+bot.session.middleware(send_scheduler)
+dp = Dispatcher(storage=fsm_storage)
+
+# Метрики: время, исход и SQL обработки по обработчикам, вызовы Telegram API (после планировщика — чистое время запроса)
+metrics = Metrics()
+# FSM-middleware диспетчера переставляем внутрь: загрузка состояния тоже попадает во время и SQL обновления
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(UpdateMetricsMiddleware(metrics, db))
+dp.update.outer_middleware(dp.fsm)
+for observer in (dp.message, dp.callback_query, dp.pre_checkout_query, dp.inline_query):
+    observer.middleware(HandlerLabelMiddleware())
+bot.session.middleware(ApiMetricsMiddleware(metrics))
+sessions = SessionStore(fsm_storage, bot.id)
+
+catalog = Catalog(db)
+drafts = DraftStore(db)
+edit_coalescer = EditCoalescer()
+compactor = BouquetCompactor(db)
+admin_outbox = AdminOutbox(db, bot, ADMIN_ID)
+cart_views = CartViews()
+catalog_search = CatalogSearch(db, catalog)
+
+metrics.gauge("bot_send_scheduler", "Outgoing request scheduler: queue depth and counters",
+              lambda: {(("stat", k),): v for k, v in send_scheduler.stats().items()})
+metrics.gauge("bot_cache_hits", "Cache hits by cache",
+              lambda: {(("cache", "keyboards"),): keyboards.kb_cache.hits, (("cache", "cart"),): cart_views.hits,
+                       (("cache", "fsm"),): fsm_storage.hits,
+                       (("cache", "search"),): catalog_search.hits})
+metrics.gauge("bot_cache_misses", "Cache misses by cache",
+              lambda: {(("cache", "keyboards"),): keyboards.kb_cache.misses, (("cache", "cart"),): cart_views.misses,
+                       (("cache", "fsm"),): fsm_storage.misses,
+                       (("cache", "search"),): catalog_search.misses})
+metrics.gauge("bot_edits_coalesced", "Message edits skipped by coalescing", lambda: {(): edit_coalescer.saved})
+metrics.gauge("bot_db_slow_statements", "SQL statements slower than DB_SLOW_QUERY_MS", lambda: {(): db.slow_statements})
+
+# --------- Инициализация БД ---------
+# Начальный каталог: (название, цена, описание, тип, фото). Заливается одним upsert (см. migrations.py)
 INITIAL_PRODUCTS = [
     ("Розы", 220, "🌹 Классические красные розы. Символ страсти и любви.", "lonely",
      "https://i.pinimg.com/736x/a1/b1/f5/a1b1f520076d41d57fffa1a97b2432fa.jpg"),
@@ -94,91 +134,138 @@ INITIAL_PRODUCTS = [
 
 
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(CREATE_PRODUCTS_TABLE)
-        await db.execute(CREATE_CART_TABLE)
-        await db.execute(CREATE_DRAFT_TABLE)
-
-        # --- Миграция: добавляем колонку image, если её нет ---
-        try:
-            await db.execute("ALTER TABLE products ADD COLUMN image TEXT")
-        except Exception:
-            pass  # Колонка уже есть
-
-        # Заполняем товары (или обновляем ссылки, если товары есть)
-        for name, price, desc, type_f, img in INITIAL_PRODUCTS:
-            # Пытаемся вставить новый
-            try:
-                await db.execute(
-                    "INSERT INTO products (name, price, description, type, image) VALUES (?, ?, ?, ?, ?)",
-                    (name, price, desc, type_f, img)
-                )
-            except Exception:
-                # Если товар с таким именем есть — обновляем ему картинку
-                await db.execute(
-                    "UPDATE products SET image = ? WHERE name = ?",
-                    (img, name)
-                )
-
-        await db.commit()
+    # Миграции по PRAGMA user_version: на актуальной базе — только проверка версии
+    await migrations.migrate(db, INITIAL_PRODUCTS)
+    catalog.invalidate()
+    await orders.init_order_ids(db)
 
 # --------- Утилиты для работы с БД ---------
-async def get_all_products():
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Добавили image в выборку
-        cur = await db.execute("SELECT id, name, price, description, type, image FROM products ORDER BY id")
-        return await cur.fetchall()
-
 async def get_product(product_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT id, name, price, description, type FROM products WHERE id = ?", (product_id,))
-        return await cur.fetchone()
-
-async def add_to_cart(user_id: int, product_id: int, qty: int = 1):
-    async with aiosqlite.connect(DB_PATH) as db:
-        # если запись существует — обновляем количество
-        cur = await db.execute("SELECT quantity FROM cart WHERE user_id = ? AND product_id = ?", (user_id, product_id))
-        row = await cur.fetchone()
-        if row:
-            new_q = row[0] + qty
-            await db.execute("UPDATE cart SET quantity = ? WHERE user_id = ? AND product_id = ?", (new_q, user_id, product_id))
-        else:
-            await db.execute("INSERT INTO cart (user_id, product_id, quantity) VALUES (?, ?, ?)", (user_id, product_id, qty))
-        await db.commit()
-
-async def remove_one_from_cart(user_id: int, product_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT quantity FROM cart WHERE user_id = ? AND product_id = ?", (user_id, product_id))
-        row = await cur.fetchone()
-        if not row:
-            return
-        q = row[0]
-        if q > 1:
-            await db.execute("UPDATE cart SET quantity = ? WHERE user_id = ? AND product_id = ?", (q - 1, user_id, product_id))
+    return await db.fetchone("SELECT id, name, price, description, type FROM products WHERE id = ?", (product_id,))
+
+async def add_to_cart(user_id: int, product_id: int, qty: int = 1) -> int:
+    """
+    Добавляет товар одним запросом (upsert) и возвращает новое количество в корзине.
+    Несуществующий товар (устаревшая или подделанная кнопка) не добавляется — тогда возвращает 0.
+    """
+    with cart_views.change(user_id) as change:
+        row = await db.execute_fetchone("""
+            INSERT INTO cart (user_id, product_id, quantity)
+            SELECT ?, id, ? FROM products WHERE id = ?
+            ON CONFLICT(user_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity
+            RETURNING quantity, (SELECT price FROM products WHERE id = cart.product_id)
+        """, (user_id, qty, product_id))
+        if row is None:
+            change.add(0, 0)
+            return 0
+        change.add(qty, qty * row[1])
+    return row[0]
+
+PRODUCT_GONE_TEXT = "😔 Этого товара больше нет в каталоге. Откройте меню заново: /start"
+
+async def remove_one_from_cart(user_id: int, product_id: int) -> int:
+    """Убирает 1 шт. товара и возвращает оставшееся количество (0 — позиция удалена)."""
+    with cart_views.change(user_id) as change:
+        async with db.transaction() as conn:
+            # Уменьшаем, только если останется хотя бы 1 шт.
+            cur = await conn.execute("""
+                UPDATE cart SET quantity = quantity - 1
+                WHERE user_id = ? AND product_id = ? AND quantity > 1
+                RETURNING quantity, (SELECT price FROM products WHERE id = cart.product_id)
+            """, (user_id, product_id))
+            row = await cur.fetchone()
+            await cur.close()
+            if row:
+                new_qty, price = row
+            else:
+                # Иначе это была последняя штука — удаляем позицию
+                cur = await conn.execute("""
+                    DELETE FROM cart WHERE user_id = ? AND product_id = ?
+                    RETURNING (SELECT price FROM products WHERE id = cart.product_id)
+                """, (user_id, product_id))
+                deleted = await cur.fetchone()
+                await cur.close()
+                new_qty, price = 0, (deleted[0] if deleted else None)
+        if price is not None:
+            change.add(-1, -price)
         else:
-            await db.execute("DELETE FROM cart WHERE user_id = ? AND product_id = ?", (user_id, product_id))
-        await db.commit()
+            change.add(0, 0)  # Товара и не было в корзине
+    return new_qty
 
 async def clear_cart(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    with cart_views.change(user_id) as change:
         await db.execute("DELETE FROM cart WHERE user_id = ?", (user_id,))
-        await db.commit()
+        change.set(0, 0)
+
+async def get_cart_summary(user_id: int):
+    """(штук, сумма) корзины. Обычно из памяти — итоги сдвигаются при каждом изменении корзины."""
+    summary = cart_views.summary(user_id)
+    if summary is not None:
+        return summary
+    version = cart_views.version(user_id)
+    row = await db.fetchone("""
+        SELECT COALESCE(SUM(c.quantity), 0), COALESCE(SUM(c.quantity * p.price), 0)
+        FROM cart c
+        JOIN products p ON p.id = c.product_id
+        WHERE c.user_id = ?
+    """, (user_id,))
+    summary = (row[0], row[1])
+    cart_views.put_summary(user_id, version, summary)
+    return summary
+
+async def save_bouquet_items(conn, bouquet_id: int, draft_items):
+    """Перезаписывает состав букета в транзакции вызывающего кода. draft_items: [(id, name, price, qty)]"""
+    await conn.execute("DELETE FROM bouquet_items WHERE bouquet_id = ?", (bouquet_id,))
+    await conn.executemany(
+        "INSERT INTO bouquet_items (bouquet_id, product_id, quantity, unit_price) VALUES (?, ?, ?, ?)",
+        [(bouquet_id, pid, qty, price) for pid, _, price, qty in draft_items]
+    )
+
+async def get_bouquet_items(bouquet_ids):
+    """Состав нескольких букетов одним запросом: {bouquet_id: [(product_id, name, qty, unit_price)]}"""
+    bouquet_ids = list(bouquet_ids)
+    result = {bid: [] for bid in bouquet_ids}
+    if not bouquet_ids:
+        return result
+    placeholders = ", ".join("?" for _ in bouquet_ids)
+    rows = await db.fetchall(f"""
+        SELECT bi.bouquet_id, bi.product_id, p.name, bi.quantity, bi.unit_price
+        FROM bouquet_items bi
+        JOIN products p ON p.id = bi.product_id
+        WHERE bi.bouquet_id IN ({placeholders})
+        ORDER BY bi.bouquet_id, bi.rowid
+    """, bouquet_ids)
+    for bid, pid, name, qty, unit_price in rows:
+        result[bid].append((pid, name, qty, unit_price))
+    return result
+
+async def get_cart_bouquet_items(user_id: int):
+    """Состав всех собранных букетов из корзины пользователя одним запросом (формат как у get_bouquet_items)."""
+    rows = await db.fetchall("""
+        SELECT bi.bouquet_id, bi.product_id, p.name, bi.quantity, bi.unit_price
+        FROM cart c
+        JOIN bouquet_items bi ON bi.bouquet_id = c.product_id
+        JOIN products p ON p.id = bi.product_id
+        WHERE c.user_id = ?
+        ORDER BY bi.bouquet_id, bi.rowid
+    """, (user_id,))
+    result = {}
+    for bid, pid, name, qty, unit_price in rows:
+        result.setdefault(bid, []).append((pid, name, qty, unit_price))
+    return result
 
 async def get_cart(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Добавили p.description и p.type в выборку
-        cur = await db.execute("""
-            SELECT p.id, p.name, p.price, c.quantity, p.description, p.type
-            FROM cart c
-            JOIN products p ON p.id = c.product_id
-            WHERE c.user_id = ?
-            ORDER BY p.id
-        """, (user_id,))
-        return await cur.fetchall()
+    # Добавили p.description и p.type в выборку
+    return await db.fetchall("""
+        SELECT p.id, p.name, p.price, c.quantity, p.description, p.type
+        FROM cart c
+        JOIN products p ON p.id = c.product_id
+        WHERE c.user_id = ?
+        ORDER BY p.id
+    """, (user_id,))
 
 # --------- Клавиатуры ---------
 def build_start_keyboard(products):
-    print(products)
     kb = []
     i = 0
     while i < len(products):
@@ -223,26 +310,65 @@ def cart_kb(cart_items):
     return InlineKeyboardMarkup(inline_keyboard=kb_rows)
 
 
-async def show_creation_menu(message: Message, user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        # 1. Получаем текущий черновик
-        cur = await db.execute("""
-            SELECT p.id, p.name, p.price, d.quantity 
-            FROM bouquet_draft d
-            JOIN products p ON p.id = d.product_id
-            WHERE d.user_id = ?
-        """, (user_id,))
-        draft_items = await cur.fetchall()
-
-        # 2. Получаем сумму корзины
-        cur = await db.execute("""
-            SELECT c.quantity, p.price 
-            FROM cart c
-            JOIN products p ON p.id = c.product_id
-            WHERE c.user_id = ?
-        """, (user_id,))
-        cart_rows = await cur.fetchall()
-        cart_total = sum(qty * price for qty, price in cart_rows)
+async def render_cart(user_id: int):
+    """Текст и клавиатура корзины. Пока корзина (и каталог) не менялись — берем готовое из кэша."""
+    version = cart_views.version(user_id)
+    cached = cart_views.get(user_id, catalog.version)
+    if cached is not None:
+        return cached
+
+    items = await get_cart(user_id)
+    if not items:
+        kb = InlineKeyboardMarkup(
+            inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="main_menu")]])
+        rendered = ("🧺 Ваша корзина пуста — время добавить немного цветов!", kb)
+        cart_views.put(user_id, version, catalog.version, rendered)
+        cart_views.put_summary(user_id, version, (0, 0))
+        return rendered
+
+    # Формируем текст корзины
+    lines = []
+    total = 0
+    for pid, name, price, qty, desc, p_type in items:
+        summ = price * qty
+        total += summ
+        # Основная строка
+        item_text = f"🔹 <b>{name}</b>\n     {price} ₽ × {qty} шт. = {summ} ₽"
+
+        # Если это авторский букет, добавляем состав (он лежит в description)
+        if p_type == "created_bouquet" and desc:
+            # Убираем "Состав: " для красоты, если оно там есть, и делаем курсивом
+            clean_desc = desc.replace("Состав: ", "").strip()
+            item_text += f"\n     <i>└ {clean_desc}</i>"
+
+        lines.append(item_text)
+
+    text = "<b>🧺 Ваша корзина:</b>\n\n" + "\n\n".join(
+        lines) + f"\n\n💰 Итого к оплате: <b>{total} ₽</b>\n\nМы приготовим всё красиво и аккуратно — осталось оформить."
+    rendered = (text, cart_kb(items))
+    cart_views.put(user_id, version, catalog.version, rendered)
+    # Заодно сверяем итоги с БД — корзину все равно уже прочитали целиком
+    cart_views.put_summary(user_id, version, (sum(qty for _, _, _, qty, _, _ in items), total))
+    return rendered
+
+
+async def get_draft_items(user_id: int):
+    """Состав черновика [(id, name, price, qty)] — из памяти и кэша каталога, без запросов к БД."""
+    draft = await drafts.items(user_id)
+    items = []
+    for pid, qty in draft.items():
+        product = await catalog.get(pid)
+        if product:
+            items.append((pid, product[1], product[2], qty))
+    return items
+
+
+async def build_creation_text(user_id: int) -> str:
+    # 1. Получаем текущий черновик
+    draft_items = await get_draft_items(user_id)
+
+    # 2. Получаем сумму корзины (поддерживается инкрементально, без чтения всей корзины)
+    _, cart_total = await get_cart_summary(user_id)
 
     # Считаем сумму текущего букета
     draft_lines = []
@@ -272,99 +398,120 @@ async def show_creation_menu(message: Message, user_id: int):
         text += f"\n💰 <b>Общая сумма заказа: {grand_total} ₽</b>"
     else:
         text += f"\n\n💰 <b>Общая сумма заказа: {grand_total} ₽</b>"
+    return text
 
-    # Кнопки
-    all_products = await get_all_products()
-    bouquets = [p for p in all_products if p[4] == "lonely"]
-    kb = []
-    for pid, name, price, *_ in bouquets:
-        kb.append([InlineKeyboardButton(text=f"🔍 {name} — {price} ₽", callback_data=f"view_flower_{pid}")])
-
-        kb.append([
-            InlineKeyboardButton(text="+1", callback_data=f"bq_add_{pid}_1"),
-            InlineKeyboardButton(text="+10", callback_data=f"bq_add_{pid}_10"),
-            InlineKeyboardButton(text="-1", callback_data=f"bq_sub_{pid}_1"),
-            InlineKeyboardButton(text="🗑", callback_data=f"bq_del_{pid}")
-        ])
 
-    kb.append([InlineKeyboardButton(text="🎁 Упаковать (+15₽) и в корзину", callback_data="pack_yes"),
-               InlineKeyboardButton(text="🚫 В корзину без упаковки", callback_data="pack_no")])
-    kb.append([InlineKeyboardButton(text="🧹 Сбросить всё", callback_data="reset_draft")])
+async def show_creation_menu(message: Message, user_id: int, after: int = 0):
+    # Частые нажатия схлопываются: рендер и edit_text выполнятся один раз на окно
+    async def render():
+        text = await build_creation_text(user_id)
 
-    # Кнопка назад / сохранить
-    if user_id in user_states and 'editing_pid' in user_states[user_id]:
-        kb.append([InlineKeyboardButton(text="💾 Сохранить и выйти", callback_data="back_from_creation")])
-    else:
-        kb.append([InlineKeyboardButton(text="🔙 Назад (без сохранения)", callback_data="back_from_creation")])
+        # Кнопки (готовая клавиатура страницы из кэша; after — курсор страницы цветов)
+        editing = 'editing_pid' in await sessions.get(user_id)
+        kb = await keyboards.creation_kb(catalog, editing, after)
 
-    # --- ИСПРАВЛЕНИЕ: Умная отправка ---
-    try:
-        # Сначала пробуем просто отредактировать текст (это работает для кнопок + и -)
-        await message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb), parse_mode="HTML")
-    except Exception:
-        # Если не вышло (например, там была КАРТИНКА), то удаляем старое и шлем новое
+        # --- ИСПРАВЛЕНИЕ: Умная отправка ---
         try:
-            await message.delete()
-        except:
-            pass # Если уже удалено
-        await message.answer(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb), parse_mode="HTML")
+            # Сначала пробуем просто отредактировать текст (это работает для кнопок + и -)
+            await message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+        except TelegramBadRequest as e:
+            error = str(e).lower()
+            if "not modified" in error:
+                return  # Нажатие ничего не изменило (-1 на цветке не из букета и т.п.)
+            if "no text in the message" not in error and "can't be edited" not in error:
+                raise  # Например, сообщение уже удалено — новое не шлем, чтобы не плодить дубли
+            # Сообщение нельзя отредактировать (там была КАРТИНКА) — удаляем старое и шлем новое
+            try:
+                await message.delete()
+            except:
+                pass # Если уже удалено
+            await message.answer(text, reply_markup=kb, parse_mode="HTML")
 
-# --- Универсальная функция завершения заказа ---
-async def finalize_order(message: Message, state: FSMContext, user_id: int, payment_label: str, end_text: str):
-    user = message.from_user
+    edit_coalescer.submit((message.chat.id, message.message_id), render)
 
-    # 1. Генерируем ID заказа (например, случайные цифры + ID юзера)
-    # Это позволит уникально идентифицировать заказ
-    order_ref = f"{random.randint(100, 999)}-{user_id}"
+async def notify_customer(chat_id: int, text: str, **kwargs):
+    """Сообщение клиенту о заказе. Заказ к этому моменту уже записан, поэтому ошибку Telegram не пробрасываем."""
+    try:
+        await bot.send_message(chat_id, text, **kwargs)
+    except Exception as e:
+        logger.error(f"Failed to notify chat {chat_id} about order: {e}")
+
+# --- Универсальная функция завершения заказа ---
+# Принимает чат и пользователя явно (а не Message), чтобы заказ можно было завершить и из фоновой задачи
+# payment_ref — идентификатор оплаты: повторный вызов по той же оплате не оформит второй заказ из новой корзины.
+# После коммита заказа ошибки отправки клиенту только логируются — иначе оплату попробовали бы оформить еще раз
+async def finalize_order(chat_id: int, user: types.User, state: FSMContext, payment_label: str, end_text: str,
+                         payment_ref: Optional[str] = None):
+    user_id = user.id
+    if payment_ref is not None:
+        existing = await orders.find_paid_order(db, payment_ref)
+        if existing is not None:
+            logger.info(f"Payment {payment_ref} already placed as order {existing}")
+            return
 
-    # 2. Достаем данные из State
+    # 1. Достаем данные из State
     data = await state.get_data()
     address = data.get("temp_address", "Не указан")
     delivery_time = data.get("delivery_time", "Не указано")
 
-    # 3. Достаем корзину
-    items = await get_cart(user_id)
-    if not items:
-        await message.answer("Ошибка: Корзина пуста. Если вы оплатили заказ, пожалуйста, перешлите чек флористу.")
-        return
+    # 2. Состав собранных букетов читаем заранее — отчет админу собирается внутри транзакции заказа
+    compositions = await get_cart_bouquet_items(user_id)
 
-    # 4. Считаем итог
-    total_price = 0
-    cart_text = ""
-    for _, name, price, qty, desc, p_type in items:
-        summ = price * qty
-        total_price += summ
-        cart_text += f"▫️ {name} x {qty} = {summ} ₽\n"
-        if p_type == "created_bouquet":
-            cart_text += f"   <i>(Состав: {desc[:50]}...)</i>\n"
-
-    # 5. Отчет Админу (Добавили ID заказа!)
-    admin_report = (
-        f"🚨 <b>НОВЫЙ ЗАКАЗ #{order_ref}</b>\n"
-        f"👤 Клиент: <a href='tg://user?id={user_id}'>{user.full_name}</a> (@{user.username})\n"
-        f"🆔 ID заказа: <code>{order_ref}</code>\n"
-        f"📍 <b>Адрес:</b> {address}\n"
-        f"⏰ <b>Время:</b> {delivery_time}\n"
-        f"💰 <b>Тип оплаты:</b> {payment_label}\n"
-        f"〰〰〰〰〰〰〰\n"
-        f"{cart_text}"
-        f"〰〰〰〰〰〰〰\n"
-        f"💰 <b>ИТОГО: {total_price} ₽</b>"
-    )
-    if ADMIN_ID:
-        try: await bot.send_message(ADMIN_ID, admin_report, parse_mode="HTML")
-        except Exception as e: print(f"Ошибка отправки админу: {e}")
+    # 3. Отчет Админу (Добавили ID заказа!)
+    def build_admin_report(order_id: int, items) -> str:
+        total_price = 0
+        cart_text = ""
+        for pid, name, price, qty, desc, p_type in items:
+            summ = price * qty
+            total_price += summ
+            cart_text += f"▫️ {name} x {qty} = {summ} ₽\n"
+            if p_type == "created_bouquet":
+                if compositions.get(pid):
+                    parts = ", ".join(f"{f_name} × {f_qty}" for _, f_name, f_qty, _ in compositions[pid])
+                    cart_text += f"   <i>(Состав: {parts})</i>\n"
+                else:
+                    cart_text += f"   <i>(Состав: {desc[:50]}...)</i>\n"
+        return (
+            f"🚨 <b>НОВЫЙ ЗАКАЗ #{order_id}</b>\n"
+            f"👤 Клиент: <a href='tg://user?id={user_id}'>{user.full_name}</a> (@{user.username})\n"
+            f"🆔 ID заказа: <code>{order_id}</code>\n"
+            f"📍 <b>Адрес:</b> {address}\n"
+            f"⏰ <b>Время:</b> {delivery_time}\n"
+            f"💰 <b>Тип оплаты:</b> {payment_label}\n"
+            f"〰〰〰〰〰〰〰\n"
+            f"{cart_text}"
+            f"〰〰〰〰〰〰〰\n"
+            f"💰 <b>ИТОГО: {total_price} ₽</b>"
+        )
 
-    # 6. Очистка
-    await clear_cart(user_id)
+    async def notify_admin(conn, order_id: int, items):
+        # Отчет пишется в admin_outbox той же транзакцией, что и заказ: либо есть оба, либо ни одного
+        await admin_outbox.add(conn, build_admin_report(order_id, items))
+
+    # 4. Сохраняем заказ: корзина переносится в orders/order_items и очищается одной транзакцией.
+    # Номер заказа монотонный и упорядочен по времени (orders.OrderIdGenerator) — совпадений не бывает
+    with cart_views.change(user_id) as change:
+        placed = await orders.place_order(db, user_id, chat_id, payment_label, address, delivery_time,
+                                          payment_ref=payment_ref, on_placed=notify_admin)
+        change.set(0, 0)
+    if placed is None:
+        await notify_customer(chat_id, "Ошибка: Корзина пуста. Если вы оплатили заказ, пожалуйста, перешлите чек флористу.")
+        return
+    order_id, items = placed
+    order_ref = str(order_id)
+    # Не ждем Telegram: фоновый отправщик доставит отчет с повторами
+    admin_outbox.wake()
+
+    # 5. Очистка (корзину уже очистила транзакция заказа)
     await state.clear()
 
-    # 7. Ответ пользователю (Добавили контакты и ID)
+    # 6. Ответ пользователю (Добавили контакты и ID)
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🌸 В главное меню", callback_data="main_menu")]
     ])
     florist_contact = "@matvey_sadovsky"
-    await message.answer(
+    await notify_customer(
+        chat_id,
         f"🎉 <b>Ваш заказ #{order_ref} принят!</b>\n\n"
         f"Способ оплаты: <i>{payment_label}</i>\n"
         f"Адрес: <i>{address}</i>\n"
@@ -379,14 +526,47 @@ async def finalize_order(message: Message, state: FSMContext, user_id: int, paym
     )
 
 # --- ПРОВЕРКА КРИПТЫ ---
+CRYPTO_PAID_LABEL = "💎 CryptoBot (Оплачено)"
+CRYPTO_PAID_TEXT = "Заказ оплачен онлайн. Спасибо! 🤝"
+
+async def on_crypto_invoice_paid(invoice_id: int, context: dict):
+    """Вызывается фоновым опросом CryptoPay, когда инвойс оплачен."""
+    chat_id, user = context["chat_id"], context["user"]
+    state = dp.fsm.get_context(bot, chat_id=chat_id, user_id=user.id)
+    await finalize_order(chat_id, user, state, CRYPTO_PAID_LABEL, CRYPTO_PAID_TEXT, payment_ref=f"crypto:{invoice_id}")
+
+crypto_poller = payment_services.InvoicePoller(payment_services.crypto_client, on_crypto_invoice_paid)
+
 @dp.callback_query(F.data.startswith("check_pay_crypto_"))
 async def check_crypto_payment(call: CallbackQuery, state: FSMContext):
-    invoice_id = call.data.split("_")[3]
-    status = await payment_services.check_crypto_invoice_status(invoice_id)
+    invoice_id = int(call.data.split("_")[3])
+    # Статус берем из кэша фонового опроса — без запроса к CryptoPay на каждое нажатие
+    status = crypto_poller.status(invoice_id)
+    if status is None:
+        # Инвойс не отслеживается (например, бот перезапускался) — ставим на опрос
+        crypto_poller.track(invoice_id, {"chat_id": call.message.chat.id, "user": call.from_user})
+        await call.answer("⏳ Проверяем оплату, это займет несколько секунд.", show_alert=True)
+        return
     # 2. Проверяем, что статус именно 'paid'
     if status == 'paid':
+        context = crypto_poller.claim(invoice_id)
+        if context is None:
+            if crypto_poller.is_finished(invoice_id):
+                await call.answer("✅ Оплата получена, заказ уже оформлен!")
+            else:
+                await call.answer("✅ Оплата получена, оформляем заказ...")
+            return
         await call.answer("✅ Оплата получена!")
-        await finalize_order(call.message, state, call.from_user.id, "💎 CryptoBot (Оплачено)", "Заказ оплачен онлайн. Спасибо! 🤝")
+        try:
+            await finalize_order(call.message.chat.id, call.from_user, state, CRYPTO_PAID_LABEL, CRYPTO_PAID_TEXT,
+                                 payment_ref=f"crypto:{invoice_id}")
+        except Exception:
+            # Инвойс снова в очереди, фоновый опрос повторит; если заказ успел записаться, повтор его найдет по payment_ref
+            crypto_poller.release(invoice_id)
+            raise
+        crypto_poller.complete(invoice_id)
+    elif status == 'expired':
+        await call.answer("⌛ Счет истек. Вернитесь назад и создайте новый.", show_alert=True)
     else: await call.answer("❌ Оплата еще не видна. Подождите минуту.", show_alert=True)
 
 
@@ -409,7 +589,8 @@ async def process_successful_payment(message: Message, state: FSMContext):
     # Формируем красивый текст для админа
     payment_label = f"💳 Portmone (Оплачено: {total_amount} {currency})"
     end_text = "Оплата прошла успешно! Мы уже начали собирать ваш букет. 💐"
-    await finalize_order(message, state, user_id, payment_label, end_text)
+    await finalize_order(message.chat.id, message.from_user, state, payment_label, end_text,
+                         payment_ref=f"telegram:{payment_info.telegram_payment_charge_id}")
 
 # Выбор оплаты
 @dp.callback_query(OrderState.waiting_for_payment_type)
@@ -428,12 +609,11 @@ async def process_payment_selection(call: CallbackQuery, state: FSMContext):
         await call.message.edit_text("Выберите удобный способ оплаты:", reply_markup=kb)
         return
 
-    # Получаем товары
-    items = await get_cart(user_id)
-    if not items:
+    # Итоги корзины
+    count, total_price = await get_cart_summary(user_id)
+    if not count:
         await call.answer("Корзина пуста!", show_alert=True)
         return
-    total_price = sum(price * qty for _, _, price, qty, _, _ in items)
 
     # --- 1. КРИПТОВАЛЮТА ---
     if payment_type == "pay_crypto":
@@ -448,6 +628,8 @@ async def process_payment_selection(call: CallbackQuery, state: FSMContext):
         if not invoice_url:
             await call.message.edit_text("Ошибка создания счета CryptoBot.")
             return
+        # Дальше статус оплаты отслеживает фоновый опрос — заказ оформится сам
+        crypto_poller.track(invoice_id, {"chat_id": call.message.chat.id, "user": user})
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text=f"👉 Оплатить {amount_usdt} RUB", url=invoice_url)],
             [InlineKeyboardButton(text="🔄 Я оплатил", callback_data=f"check_pay_crypto_{invoice_id}")],
@@ -490,40 +672,16 @@ async def process_payment_selection(call: CallbackQuery, state: FSMContext):
     else:
         await call.answer()
         return
-    await finalize_order(call.message, state, user_id, payment_label, end_text)
-
-user_states = {}
+    await finalize_order(call.message.chat.id, user, state, payment_label, end_text)
 
 # --- КНОПКА ОТМЕНЫ (на любом этапе) ---
 @dp.callback_query(F.data == "cancel_order")
 async def cancel_fsm(call: CallbackQuery, state: FSMContext):
     user_id = call.from_user.id
     await state.clear()
-    items = await get_cart(user_id)
-    if not items:
-        kb = InlineKeyboardMarkup(
-            inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="main_menu")]])
-        await call.message.edit_text("🧺 Ваша корзина пуста — время добавить немного цветов!", reply_markup=kb)
-        await call.answer()
-        return
-    # Формируем текст корзины
-    lines = []
-    total = 0
-    for pid, name, price, qty, desc, p_type in items:
-        summ = price * qty
-        total += summ
-        # Основная строка
-        item_text = f"🔹 <b>{name}</b>\n     {price} ₽ × {qty} шт. = {summ} ₽"
-        # Если это авторский букет, добавляем состав (он лежит в description)
-        if p_type == "created_bouquet" and desc:
-            # Убираем "Состав: " для красоты, если оно там есть, и делаем курсивом
-            clean_desc = desc.replace("Состав: ", "").strip()
-            item_text += f"\n     <i>└ {clean_desc}</i>"
-        lines.append(item_text)
-    
-    text = "<b>🧺 Ваша корзина:</b>\n\n" + "\n\n".join(lines) + f"\n\n💰 Итого к оплате: <b>{total} ₽</b>\n\nМы приготовим всё красиво и аккуратно — осталось оформить."
-    await call.message.edit_text(text, reply_markup=cart_kb(items), parse_mode="HTML")
-    return
+    text, kb = await render_cart(user_id)
+    await call.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    await call.answer()
 
 # --- НОВЫЙ ХЭНДЛЕР ДЛЯ ОФОРМЛЕНИЯ (Вставить ПЕРЕД generic_callback) ---
 @dp.callback_query(F.data == "checkout")
@@ -551,218 +709,222 @@ async def start_checkout_handler(call: CallbackQuery, state: FSMContext):
 async def cmd_start(message: Message, state: FSMContext):
     await state.clear()
     
-    all_products = await get_all_products()
-    bouquets = [p for p in all_products if p[4] == "bouquet"]
-
-    kb = []
-    # Кнопки теперь ведут на просмотр (view_product_)
-    for pid, name, price, desc, p_type, _ in bouquets:
-        kb.append([InlineKeyboardButton(text=f"👁 {name} — {price} ₽", callback_data=f"view_product_{pid}")])
-
-    kb.append([InlineKeyboardButton(text="🌸 Создать свой букет", callback_data="create_bouquet")])
-    kb.append([InlineKeyboardButton(text="🧺 Перейти в корзину", callback_data="view_cart")])
+    kb = await keyboards.main_menu_kb(catalog)
 
     await message.answer(
         "🌿 <b>Bloom & Vibe</b>\n\nНажмите на название букета, чтобы увидеть фото и описание. 👇",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=kb),
+        reply_markup=kb,
         parse_mode="HTML"
     )
 
-@dp.callback_query()
-async def generic_callback(call: CallbackQuery, state: FSMContext):
-    data = call.data or ""
-    user_id = call.from_user.id
-
-    # Вернуться в главное меню (ТОТ ЖЕ НОВЫЙ ДИЗАЙН)
-    if data == "main_menu":
-        # Сначала пробуем удалить старое сообщение (если это была картинка)
-        try:
-            await call.message.delete()
-        except:
-            pass  # Если не получилось удалить (уже удалено), просто шлем новое
-
-        all_products = await get_all_products()
-        bouquets = [p for p in all_products if p[4] == "bouquet"]
-
-        kb = []
-        for pid, name, price, desc, p_type, _ in bouquets:
-            kb.append([InlineKeyboardButton(text=f"👁 {name} — {price} ₽", callback_data=f"view_product_{pid}")])
-
-        kb.append([InlineKeyboardButton(text="🌸 Создать свой букет", callback_data="create_bouquet")])
-        kb.append([InlineKeyboardButton(text="🧺 Перейти в корзину", callback_data="view_cart")])
-
-        await call.message.answer(
-            "🌿 <b>Bloom & Vibe</b>\n\nНажмите на название букета, чтобы увидеть фото и описание. 👇",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=kb),
-            parse_mode="HTML"
-        )
+# --- Inline-поиск по каталогу: @бот розы ---
+@dp.inline_query()
+async def inline_search(query: InlineQuery):
+    results = []
+    for pid, name, price, desc, _, img_url in await catalog_search.search(query.query):
+        caption = f"💐 <b>{name}</b>\n\n<i>{desc or ''}</i>\n\n💰 <b>Цена: {price} ₽</b>"
+        file_id = catalog.file_id(pid)
+        if file_id:
+            # Фото уже загружено в Telegram — отдаем по file_id, без скачивания по ссылке
+            results.append(InlineQueryResultCachedPhoto(
+                id=str(pid), photo_file_id=file_id, title=name, caption=caption, parse_mode="HTML"))
+        else:
+            img_url = img_url or "https://images.unsplash.com/photo-1562690868-60bbe7293e94?auto=format&fit=crop&w=1000&q=80"
+            results.append(InlineQueryResultPhoto(
+                id=str(pid), photo_url=img_url, thumbnail_url=img_url, title=name, caption=caption,
+                parse_mode="HTML"))
+    await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=False)
+
+# --- Поддержка: поиск заказа по номеру и отчет за сегодня (только для админа) ---
+def is_admin(user_id: int) -> bool:
+    return bool(ADMIN_ID) and str(user_id) == str(ADMIN_ID)
+
+# --- История заказов покупателя ---
+@dp.message(F.text == "/orders")
+async def cmd_my_orders(message: Message):
+    rows = await orders.get_user_orders(db, message.from_user.id)
+    if not rows:
+        await message.answer("У вас пока нет заказов. Загляните в каталог: /start")
         return
-
-    if data.startswith("view_flower_"):
-        try:
-            pid = int(data.split("_")[2])
-        except:
-            await call.answer()
-            return
-
-        try:
-            await call.message.delete()
-        except:
-            pass
-
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute("SELECT name, price, description, image FROM products WHERE id = ?", (pid,))
-            row = await cur.fetchone()
-
-        if row:
-            name, price, desc, img_url = row
-            # Запасная картинка, если в базе пусто
-            if not img_url:
-                img_url = "https://images.unsplash.com/photo-1562690868-60bbe7293e94"
-
-            caption = f"🌺 <b>{name}</b>\n\n{desc}\n\n💰 Цена за шт: <b>{price} ₽</b>"
-
-            kb = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Назад к сборке", callback_data="resume_creation")]
-            ])
-
-            # Пытаемся отправить фото. Если ссылка плохая — шлем заглушку.
-            try:
-                await call.message.answer_photo(photo=img_url, caption=caption, reply_markup=kb, parse_mode="HTML")
-            except Exception:
-                # Если конкретная картинка (например, Ранункулюсов) не грузится
-                fallback_url = "https://images.unsplash.com/photo-1562690868-60bbe7293e94"
-                await call.message.answer_photo(photo=fallback_url, caption=caption, reply_markup=kb, parse_mode="HTML")
-
-        await call.answer()
+    text = "".join(f"• <code>{order_id}</code> от {datetime.fromtimestamp(created_at):%d.%m.%Y %H:%M} — "
+                   f"{total} ₽ ({status})\n" for order_id, status, total, created_at in rows)
+    await message.answer(f"🧾 <b>Ваши последние заказы</b>\n{text}", parse_mode="HTML")
+
+# Не-админ до обработчика не доходит — его сообщение разберут следующие (например, ввод адреса)
+@dp.message(Command("order"), F.from_user.id.func(is_admin))
+async def cmd_order(message: Message, command: CommandObject):
+    arg = (command.args or "").strip()
+    if not arg.isdigit():
+        await message.answer("Использование: /order <номер заказа>")
         return
+    found = await orders.get_order(db, int(arg))
+    if found is None:
+        await message.answer("Заказ не найден.")
+        return
+    (order_id, user_id, _, status, payment_label, address, delivery_time, total, created_at), items = found
+    lines = "".join(f"▫️ {name} x {qty} = {qty * price} ₽\n" for _, name, qty, price in items)
+    await message.answer(
+        f"🧾 <b>Заказ #{order_id}</b> ({status})\n"
+        f"🕒 {datetime.fromtimestamp(created_at):%d.%m.%Y %H:%M}\n"
+        f"👤 <a href='tg://user?id={user_id}'>{user_id}</a>\n"
+        f"📍 {address}\n⏰ {delivery_time}\n💰 {payment_label}\n"
+        f"〰〰〰〰〰〰〰\n{lines}〰〰〰〰〰〰〰\n"
+        f"<b>ИТОГО: {total} ₽</b>",
+        parse_mode="HTML"
+    )
 
-    # Просмотр товара (Карточка товара)
-    if data.startswith("view_product_"):
-        try:
-            pid = int(data.split("_")[2])
-        except:
-            return
+@dp.message(F.text == "/report")
+async def cmd_report(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    rows = await orders.get_orders_summary(db, start, start + 24 * 3600)
+    if not rows:
+        await message.answer("Сегодня заказов пока нет.")
+        return
+    text = "".join(f"• {status}: {count} шт. на {revenue} ₽\n" for status, count, revenue in rows)
+    await message.answer(f"📊 <b>Заказы за сегодня</b>\n{text}", parse_mode="HTML")
+
+# --------- Обработчики кнопок (callback_data) ---------
+# Каждое действие — отдельная функция; аргументы из callback_data уже разобраны и приведены к типам
+callback_router = CallbackRouter()
+route = callback_router.route
+
+# Вернуться в главное меню (ТОТ ЖЕ НОВЫЙ ДИЗАЙН)
+@route("main_menu")
+async def cb_main_menu(call: CallbackQuery, state: FSMContext):
+    # Сначала пробуем удалить старое сообщение (если это была картинка)
+    try:
+        await call.message.delete()
+    except:
+        pass  # Если не получилось удалить (уже удалено), просто шлем новое
 
-        # Удаляем предыдущее меню
-        try:
-            await call.message.delete()
-        except:
-            pass
+    kb = await keyboards.main_menu_kb(catalog)
 
-        async with aiosqlite.connect(DB_PATH) as db:
-            # --- ИСПРАВЛЕНИЕ: Добавили image в запрос ---
-            cur = await db.execute("SELECT name, price, description, image FROM products WHERE id = ?", (pid,))
-            row = await cur.fetchone()
+    await call.message.answer(
+        "🌿 <b>Bloom & Vibe</b>\n\nНажмите на название букета, чтобы увидеть фото и описание. 👇",
+        reply_markup=kb,
+        parse_mode="HTML"
+    )
 
-        if not row:
-            await call.answer("Товар не найден", show_alert=True)
-            return
+@route("view_flower", int)
+async def cb_view_flower(call: CallbackQuery, state: FSMContext, pid: int):
+    try:
+        await call.message.delete()
+    except:
+        pass
 
-        # --- ИСПРАВЛЕНИЕ: Распаковываем 4 значения ---
-        name, price, desc, img_url = row
+    product = await catalog.get(pid)
 
-        # Если вдруг картинки нет в базе, ставим запасную
+    if product:
+        _, name, price, desc, _, img_url = product
+        # Запасная картинка, если в базе пусто
         if not img_url:
-            img_url = "https://images.unsplash.com/photo-1562690868-60bbe7293e94?auto=format&fit=crop&w=1000&q=80"
+            img_url = "https://images.unsplash.com/photo-1562690868-60bbe7293e94"
 
-        caption = f"💐 <b>{name}</b>\n\n<i>{desc}</i>\n\n💰 <b>Цена: {price} ₽</b>"
+        caption = f"🌺 <b>{name}</b>\n\n{desc}\n\n💰 Цена за шт: <b>{price} ₽</b>"
 
-        # --- КЛАВИАТУРА ---
         kb = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="➖ С корзины", callback_data=f"remove_from_view_{pid}"),
-                InlineKeyboardButton(text="➕ В корзину", callback_data=f"add_from_view_{pid}")
-            ],
-            [InlineKeyboardButton(text="⬅️ Назад к списку", callback_data="main_menu")]
+            [InlineKeyboardButton(text="🔙 Назад к сборке", callback_data="resume_creation")]
         ])
 
-        # Отправляем фото
-        try:
-            await call.message.answer_photo(photo=img_url, caption=caption, reply_markup=kb, parse_mode="HTML")
-        except Exception:
-            # Если ссылка Pinterest не грузится, пробуем запасную
-            fallback = "https://images.unsplash.com/photo-1562690868-60bbe7293e94?auto=format&fit=crop&w=1000&q=80"
-            await call.message.answer_photo(photo=fallback, caption=caption, reply_markup=kb, parse_mode="HTML")
-
-        return
+        # Пытаемся отправить фото (по file_id, если уже загружали). Если ссылка плохая — шлем заглушку.
+        fallback_url = "https://images.unsplash.com/photo-1562690868-60bbe7293e94"
+        await photos.send_product_photo(call.message, catalog, pid, img_url, caption, kb, fallback_url)
 
-    # Удаление из режима просмотра (кнопка Минус)
-    if data.startswith("remove_from_view_"):
-        try:
-            pid = int(data.split("_")[3])
-        except:
-            return
+    await call.answer()
 
-        # 1. Удаляем 1 штуку (используем готовую функцию)
-        await remove_one_from_cart(user_id, pid)
+# Просмотр товара (Карточка товара)
+@route("view_product", int)
+async def cb_view_product(call: CallbackQuery, state: FSMContext, pid: int):
+    # Удаляем предыдущее меню
+    try:
+        await call.message.delete()
+    except:
+        pass
 
-        # 2. Узнаем, сколько осталось (чтобы красиво написать)
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute("SELECT quantity FROM cart WHERE user_id = ? AND product_id = ?", (user_id, pid))
-            row = await cur.fetchone()
-            new_qty = row[0] if row else 0
+    product = await catalog.get(pid)
 
-        # 3. Показываем уведомление
-        if new_qty > 0: await call.answer(f"➖ Убрали. Осталось: {new_qty} шт.", show_alert=False)
-        else: await call.answer("🗑 Товар полностью удален из корзины", show_alert=False)
+    if not product:
+        await call.answer("Товар не найден", show_alert=True)
         return
 
-    # Добавление из режима просмотра
-    if data.startswith("add_from_view_"):
-        try:
-            pid = int(data.split("_")[3])
-        except:
-            return
+    _, name, price, desc, _, img_url = product
 
-        # 1. Добавляем товар
-        await add_to_cart(user_id, pid, 1)
+    # Если вдруг картинки нет в базе, ставим запасную
+    if not img_url:
+        img_url = "https://images.unsplash.com/photo-1562690868-60bbe7293e94?auto=format&fit=crop&w=1000&q=80"
 
-        # 2. Узнаем, сколько их теперь стало
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute("SELECT quantity FROM cart WHERE user_id = ? AND product_id = ?", (user_id, pid))
-            row = await cur.fetchone()
-            new_qty = row[0] if row else 0
+    caption = f"💐 <b>{name}</b>\n\n<i>{desc}</i>\n\n💰 <b>Цена: {price} ₽</b>"
 
-        # 3. Пишем количество в уведомлении
-        await call.answer(f"✅ Добавлено! Теперь в корзине: {new_qty} шт.", show_alert=False)
+    # --- КЛАВИАТУРА ---
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="➖ С корзины", callback_data=f"remove_from_view_{pid}"),
+            InlineKeyboardButton(text="➕ В корзину", callback_data=f"add_from_view_{pid}")
+        ],
+        [InlineKeyboardButton(text="⬅️ Назад к списку", callback_data="main_menu")]
+    ])
+
+    # Отправляем фото (если ссылка Pinterest не грузится, пробуем запасную)
+    fallback = "https://images.unsplash.com/photo-1562690868-60bbe7293e94?auto=format&fit=crop&w=1000&q=80"
+    await photos.send_product_photo(call.message, catalog, pid, img_url, caption, kb, fallback)
+
+# Удаление из режима просмотра (кнопка Минус)
+@route("remove_from_view", int)
+async def cb_remove_from_view(call: CallbackQuery, state: FSMContext, pid: int):
+    # 1. Удаляем 1 штуку — функция сразу возвращает, сколько осталось
+    new_qty = await remove_one_from_cart(call.from_user.id, pid)
+
+    # 2. Показываем уведомление
+    if new_qty > 0: await call.answer(f"➖ Убрали. Осталось: {new_qty} шт.", show_alert=False)
+    else: await call.answer("🗑 Товар полностью удален из корзины", show_alert=False)
+
+# Добавление из режима просмотра
+@route("add_from_view", int)
+async def cb_add_from_view(call: CallbackQuery, state: FSMContext, pid: int):
+    # 1. Добавляем товар — функция сразу возвращает, сколько их теперь стало
+    new_qty = await add_to_cart(call.from_user.id, pid, 1)
+    if not new_qty:
+        await call.answer(PRODUCT_GONE_TEXT, show_alert=True)
         return
 
-    if data == "create_bouquet":
-        # Если пользователь нажал кнопку "Создать букет" в меню — он хочет новый.
-        # Поэтому мы принудительно очищаем черновик.
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("DELETE FROM bouquet_draft WHERE user_id = ?", (user_id,))
-            await db.commit()
+    # 2. Пишем количество в уведомлении
+    await call.answer(f"✅ Добавлено! Теперь в корзине: {new_qty} шт.", show_alert=False)
 
-        # Также сбрасываем состояние редактирования, если оно вдруг зависло
-        if user_id in user_states:
-            user_states[user_id].pop('editing_pid', None)
+@route("create_bouquet")
+async def cb_create_bouquet(call: CallbackQuery, state: FSMContext):
+    user_id = call.from_user.id
+    # Если пользователь нажал кнопку "Создать букет" в меню — он хочет новый.
+    # Поэтому мы принудительно очищаем черновик.
+    drafts.clear(user_id)
 
-        await show_creation_menu(call.message, user_id)
-        return
+    # Также сбрасываем состояние редактирования, если оно вдруг зависло
+    await sessions.discard(user_id, 'editing_pid')
 
-    # Продолжить сборку (вернуться, не удаляя черновик)
-    if data == "resume_creation":
-        await show_creation_menu(call.message, user_id)
-        return
+    await show_creation_menu(call.message, user_id)
 
-    if data == "back_from_creation":
-        async with aiosqlite.connect(DB_PATH) as db:
-            # СЦЕНАРИЙ 1: Мы РЕДАКТИРОВАЛИ существующий букет
-            if user_id in user_states and 'editing_pid' in user_states[user_id]:
-                old_pid = user_states[user_id]['editing_pid']
+# Продолжить сборку (вернуться, не удаляя черновик)
+@route("resume_creation")
+async def cb_resume_creation(call: CallbackQuery, state: FSMContext):
+    await show_creation_menu(call.message, call.from_user.id)
 
-                cur = await db.execute("""
-                        SELECT p.name, p.price, d.quantity 
-                        FROM bouquet_draft d JOIN products p ON p.id = d.product_id 
-                        WHERE d.user_id = ?
-                    """, (user_id,))
-                items = await cur.fetchall()
+@route("back_from_creation")
+async def cb_back_from_creation(call: CallbackQuery, state: FSMContext):
+    user_id = call.from_user.id
+    draft_items = await get_draft_items(user_id)
+    old_pid = (await sessions.get(user_id)).get('editing_pid')
+    # Пишем в корзину: итоги перечитаются из БД, рендер корзины сбросится
+    with cart_views.change(user_id):
+        async with db.transaction() as conn:
+            # СЦЕНАРИЙ 1: Мы РЕДАКТИРОВАЛИ существующий букет
+            if old_pid is not None:
+                items = [(name, price, qty) for _, name, price, qty in draft_items]
 
                 if not items:
-                    await db.execute("DELETE FROM cart WHERE user_id = ? AND product_id = ?", (user_id, old_pid))
-                    await call.answer("Пустой букет удален")
+                    await conn.execute("DELETE FROM cart WHERE user_id = ? AND product_id = ?", (user_id, old_pid))
+                    await conn.execute("DELETE FROM bouquet_items WHERE bouquet_id = ?", (old_pid,))
+                    answer_text = "Пустой букет удален"
                 else:
                     total_price = 0
                     desc_parts = []
@@ -772,156 +934,108 @@ async def generic_callback(call: CallbackQuery, state: FSMContext):
 
                     final_desc = f"Состав: {', '.join(desc_parts)}."
 
-                    await db.execute(
+                    await conn.execute(
                         "UPDATE products SET price = ?, description = ? WHERE id = ?",
                         (total_price, final_desc, old_pid)
                     )
-                    await call.answer("Изменения сохранены! ✅")
-
-                del user_states[user_id]['editing_pid']
+                    await save_bouquet_items(conn, old_pid, draft_items)
+                    answer_text = "Изменения сохранены! ✅"
 
             # СЦЕНАРИЙ 2: Мы создавали НОВЫЙ букет
             else:
-                await call.answer("Черновик удален 🗑")
+                answer_text = "Черновик удален 🗑"
 
-            await db.execute("DELETE FROM bouquet_draft WHERE user_id = ?", (user_id,))
-            await db.commit()
+            await conn.execute("DELETE FROM bouquet_draft WHERE user_id = ?", (user_id,))
+    drafts.forget(user_id)
+    await sessions.discard(user_id, 'editing_pid')
+    # Отвечаем уже после COMMIT, чтобы не держать блокировку записи во время запроса к Telegram
+    await call.answer(answer_text)
 
-        # --- ИСПРАВЛЕНИЕ: Добавили _ для приема картинки ---
-        all_products = await get_all_products()
-        bouquets = [p for p in all_products if p[4] == "bouquet"]
+    kb = await keyboards.main_menu_kb(catalog)
 
-        kb = []
-        # ТЕПЕРЬ ТУТ 6 ПЕРЕМЕННЫХ (добавлено _)
-        for pid, name, price, desc, p_type, _ in bouquets:
-            kb.append([InlineKeyboardButton(text=f"👁 {name} — {price} ₽", callback_data=f"view_product_{pid}")])
+    await call.message.edit_text(
+        "🌿 <b>Bloom & Vibe</b>\n\n"
+        "Вы вернулись в меню. Нажмите на название букета, чтобы увидеть фото и описание. 👇",
+        reply_markup=kb,
+        parse_mode="HTML"
+    )
 
-        kb.append([InlineKeyboardButton(text="🌸 Создать свой букет", callback_data="create_bouquet")])
-        kb.append([InlineKeyboardButton(text="🧺 Перейти в корзину", callback_data="view_cart")])
+@route("reset_draft")
+async def cb_reset_draft(call: CallbackQuery, state: FSMContext):
+    user_id = call.from_user.id
+    drafts.clear(user_id)
 
-        await call.message.edit_text(
-            "🌿 <b>Bloom & Vibe</b>\n\n"
-            "Вы вернулись в меню. Нажмите на название букета, чтобы увидеть фото и описание. 👇",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=kb),
-            parse_mode="HTML"
-        )
-        return
+    # Если мы редактировали старый букет и решили сбросить — забываем про редактирование
+    await sessions.discard(user_id, 'editing_pid')
 
-    if data == "reset_draft":
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("DELETE FROM bouquet_draft WHERE user_id = ?", (user_id,))
-            await db.commit()
+    await show_creation_menu(call.message, user_id)
+    await call.answer("Сборка сброшена")
 
-        # Если мы редактировали старый букет и решили сбросить — забываем про редактирование
-        if user_id in user_states and 'editing_pid' in user_states[user_id]:
-            del user_states[user_id]['editing_pid']
+# --- Конструктор: изменение количества (только память, в БД запишет фоновая задача) ---
+# После нажатия остаемся на странице, где этот цветок
+async def flower_page(pid: int) -> int:
+    return await catalog.page_cursor("lonely", pid, keyboards.CREATION_PAGE_SIZE)
 
-        await show_creation_menu(call.message, user_id)
-        await call.answer("Сборка сброшена")
-        return
+@route("bq_add", int, int)
+async def cb_bq_add(call: CallbackQuery, state: FSMContext, pid: int, qty: int):
+    # Сразу подтверждаем нажатие — сама правка сообщения может быть отложена
+    await call.answer()
+    await drafts.add(call.from_user.id, pid, qty)
+    await show_creation_menu(call.message, call.from_user.id, await flower_page(pid))
 
-    if data.startswith("bq_"):
-        parts = data.split("_")
-        action = parts[1]
-        try:
-            pid = int(parts[2])
-        except:
-            return
+@route("bq_sub", int, int)
+async def cb_bq_sub(call: CallbackQuery, state: FSMContext, pid: int, qty: int):
+    await call.answer()
+    await drafts.add(call.from_user.id, pid, -qty)
+    await show_creation_menu(call.message, call.from_user.id, await flower_page(pid))
 
-        async with aiosqlite.connect(DB_PATH) as db:
-            # --- Логика изменения количества (как и была) ---
-            cur = await db.execute("SELECT quantity FROM bouquet_draft WHERE user_id = ? AND product_id = ?",
-                                   (user_id, pid))
-            row = await cur.fetchone()
-            current_qty = row[0] if row else 0
-
-            new_qty = current_qty
-            if action == "add":
-                new_qty += int(parts[3])
-            elif action == "sub":
-                new_qty -= int(parts[3])
-            elif action == "del":
-                new_qty = 0
-
-            if new_qty <= 0:
-                await db.execute("DELETE FROM bouquet_draft WHERE user_id = ? AND product_id = ?", (user_id, pid))
-            else:
-                if row:
-                    await db.execute("UPDATE bouquet_draft SET quantity = ? WHERE user_id = ? AND product_id = ?",
-                                     (new_qty, user_id, pid))
-                else:
-                    await db.execute("INSERT INTO bouquet_draft (user_id, product_id, quantity) VALUES (?, ?, ?)",
-                                     (user_id, pid, new_qty))
-            await db.commit()
-
-            # --- Подготовка данных для чека ---
-
-            # 1. Читаем текущий букет (Draft)
-            cur = await db.execute("""
-                    SELECT p.name, p.price, d.quantity 
-                    FROM bouquet_draft d JOIN products p ON p.id = d.product_id 
-                    WHERE d.user_id = ?
-                """, (user_id,))
-            draft_items = await cur.fetchall()
-
-            # 2. Читаем основную корзину (Cart) для общей суммы
-            cur = await db.execute("""
-                    SELECT c.quantity, p.price 
-                    FROM cart c JOIN products p ON p.id = c.product_id
-                    WHERE c.user_id = ?
-                """, (user_id,))
-            cart_rows = await cur.fetchall()
-            cart_total = sum(q * p for q, p in cart_rows)
-
-        # Формируем текст
-        lines = []
-        draft_total = 0
-        for name, price, qty in draft_items:
-            s = price * qty
-            lines.append(f"{name} — {price} ₽ × {qty} = {s} ₽")
-            draft_total += s
-
-        grand_total = draft_total + cart_total
-
-        text = (
-            "🌸 <b>Конструктор букета</b>\n\n"
-            "Нажимайте на кнопки, чтобы собрать свой идеальный состав. "
-            "Как закончите — нажмите «Упаковать», и букет отправится в общую корзину. 👇\n"
-            "〰〰〰〰〰〰〰〰〰\n"
-        )
-        if lines:
-            text += "\n".join(lines) + f"\n\n💐 <b>Итог этого букета: {draft_total} ₽</b>"
-        else:
-            text += "<i>(Пока цветов не выбрано)</i>\n\n💐 <b>Итог этого букета: 0 ₽</b>"
+@route("bq_del", int)
+async def cb_bq_del(call: CallbackQuery, state: FSMContext, pid: int):
+    await call.answer()
+    await drafts.delete(call.from_user.id, pid)
+    await show_creation_menu(call.message, call.from_user.id, await flower_page(pid))
 
-        # Добавляем инфо про корзину
-        if cart_total > 0:
-            text += f"\n\n🧺 <i>В корзине уже есть товаров на: {cart_total} ₽</i>"
-            text += f"\n💰 <b>Общая сумма заказа: {grand_total} ₽</b>"
-        else:
-            text += f"\n\n💰 <b>Общая сумма заказа: {grand_total} ₽</b>"
+# --- Листание страниц (в callback_data — курсор: id последнего товара предыдущей страницы) ---
+@route("bq_page", int)
+async def cb_bq_page(call: CallbackQuery, state: FSMContext, after: int):
+    await call.answer()
+    await show_creation_menu(call.message, call.from_user.id, after)
 
-        try:
-            await call.message.edit_text(text, reply_markup=call.message.reply_markup, parse_mode="HTML")
-        except:
-            pass
+@route("menu_page", int)
+async def cb_menu_page(call: CallbackQuery, state: FSMContext, after: int):
+    await call.answer()
+    # Текст меню не меняется — правим только клавиатуру
+    kb = await keyboards.main_menu_kb(catalog, after)
+    try:
+        await call.message.edit_reply_markup(reply_markup=kb)
+    except Exception:
+        pass  # Та же страница (двойное нажатие)
+
+# Подпись «2/5» между стрелками
+@route("noop")
+async def cb_noop(call: CallbackQuery, state: FSMContext):
+    await call.answer()
+
+# pack_yes / pack_no
+@route("pack", str)
+async def cb_pack(call: CallbackQuery, state: FSMContext, choice: str):
+    if choice not in ("yes", "no"):
         await call.answer()
         return
+    user_id = call.from_user.id
 
-    if data in ["pack_yes", "pack_no"]:
-        async with aiosqlite.connect(DB_PATH) as db:
-            # 1. Достаем черновик
-            cur = await db.execute("""
-                SELECT p.name, p.price, d.quantity 
-                FROM bouquet_draft d JOIN products p ON p.id = d.product_id 
-                WHERE d.user_id = ?
-            """, (user_id,))
-            items = await cur.fetchall()
-
-            if not items:
-                await call.answer("Букет пуст! Добавьте цветы.", show_alert=True)
-                return
+    # 1. Достаем черновик (из памяти)
+    draft_items = await get_draft_items(user_id)
+    items = [(name, price, qty) for _, name, price, qty in draft_items]
+
+    if not items:
+        await call.answer("Букет пуст! Добавьте цветы.", show_alert=True)
+        return
+    old_pid = (await sessions.get(user_id)).get('editing_pid')
 
+    # Пишем в корзину: итоги перечитаются из БД, рендер корзины сбросится
+    with cart_views.change(user_id):
+        async with db.transaction() as conn:
             # 2. Считаем и формируем описание
             total_price = 0
             desc_parts = []
@@ -931,7 +1045,7 @@ async def generic_callback(call: CallbackQuery, state: FSMContext):
 
             pack_price = 0
             pack_text = "Без упаковки"
-            if data == "pack_yes":
+            if choice == "yes":
                 pack_price = 15
                 total_price += pack_price
                 pack_text = "В упаковке"
@@ -945,210 +1059,156 @@ async def generic_callback(call: CallbackQuery, state: FSMContext):
 
             # 3. Создаем временный продукт
             try:
-                await db.execute(
+                await conn.execute(
                     "INSERT INTO products (name, price, description, type) VALUES (?, ?, ?, ?)",
                     (final_name, total_price, final_desc, "created_bouquet")
                 )
             except Exception as e:
                 # На случай, если вдруг рандом совпадет (шанс мизерный, но перестрахуемся)
                 final_name = f"Авторский букет №{rand_id+1}"
-                await db.execute(
+                await conn.execute(
                     "INSERT INTO products (name, price, description, type) VALUES (?, ?, ?, ?)",
                     (final_name, total_price, final_desc, "created_bouquet")
                 )
 
             # Получаем ID только что созданного букета
-            cur = await db.execute("SELECT last_insert_rowid()")
+            cur = await conn.execute("SELECT last_insert_rowid()")
             new_product_id_row = await cur.fetchone()
             new_product_id = new_product_id_row[0]
 
+            # Структурированный состав — по нему потом редактируем букет и строим отчеты
+            await save_bouquet_items(conn, new_product_id, draft_items)
+
             # 4. Добавляем новый букет в корзину
-            await db.execute(
+            await conn.execute(
                 "INSERT INTO cart (user_id, product_id, quantity) VALUES (?, ?, 1)",
                 (user_id, new_product_id)
             )
 
             # 5. Очищаем черновик
-            await db.execute("DELETE FROM bouquet_draft WHERE user_id = ?", (user_id,))
+            await conn.execute("DELETE FROM bouquet_draft WHERE user_id = ?", (user_id,))
 
             # --- ИСПРАВЛЕНИЕ ПРОПАДАНИЯ БУКЕТА ---
             # Если мы редактировали старый букет, удаляем ЕГО только сейчас, когда новый успешно создан
-            if user_id in user_states and 'editing_pid' in user_states[user_id]:
-                old_pid = user_states[user_id]['editing_pid']
-                await db.execute("DELETE FROM cart WHERE user_id = ? AND product_id = ?", (user_id, old_pid))
-                # Можно (опционально) удалить и сам старый продукт из таблицы products, чтобы не мусорить
-                # await db.execute("DELETE FROM products WHERE id = ?", (old_pid,))
-                del user_states[user_id]['editing_pid'] # Очищаем состояние
-
-            await db.commit()
-
-        # Сообщение об успехе
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🧺 Перейти в корзину", callback_data="view_cart")],
-            [InlineKeyboardButton(text="🌸 Собрать ещё один", callback_data="create_bouquet")],
-            [InlineKeyboardButton(text="⬅️ В меню", callback_data="main_menu")]
-        ])
-        await call.message.edit_text(
-            f"🎉 <b>Готово!</b>\n\nВаш «{final_name}» добавлен в корзину.\n\n"
-            f"📝 {final_desc}\n💰 <b>Цена: {total_price} ₽</b>",
-            reply_markup=kb, parse_mode="HTML"
-        )
-        return
-
-    # Просмотр корзины
-    if data == "view_cart":
-        items = await get_cart(user_id)
-        if not items:
-            kb = InlineKeyboardMarkup(
-                inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="main_menu")]])
-            await call.message.edit_text("🧺 Ваша корзина пуста — время добавить немного цветов!", reply_markup=kb)
-            await call.answer()
-            return
-
-        # Формируем текст корзины
-        lines = []
-        total = 0
-        for pid, name, price, qty, desc, p_type in items:
-            summ = price * qty
-            total += summ
-            # Основная строка
-            item_text = f"🔹 <b>{name}</b>\n     {price} ₽ × {qty} шт. = {summ} ₽"
+            if old_pid is not None:
+                await conn.execute("DELETE FROM cart WHERE user_id = ? AND product_id = ?", (user_id, old_pid))
+                # Сам старый продукт удалит фоновая сборка мусора (compaction.py), когда на него не останется ссылок
+        # Черновик уже удален из БД в этой транзакции — убираем его и из памяти
+    drafts.forget(user_id)
+    if old_pid is not None:
+        await sessions.discard(user_id, 'editing_pid') # Очищаем состояние
+
+    # Сообщение об успехе
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🧺 Перейти в корзину", callback_data="view_cart")],
+        [InlineKeyboardButton(text="🌸 Собрать ещё один", callback_data="create_bouquet")],
+        [InlineKeyboardButton(text="⬅️ В меню", callback_data="main_menu")]
+    ])
+    await call.message.edit_text(
+        f"🎉 <b>Готово!</b>\n\nВаш «{final_name}» добавлен в корзину.\n\n"
+        f"📝 {final_desc}\n💰 <b>Цена: {total_price} ₽</b>",
+        reply_markup=kb, parse_mode="HTML"
+    )
 
-            # Если это авторский букет, добавляем состав (он лежит в description)
-            if p_type == "created_bouquet" and desc:
-                # Убираем "Состав: " для красоты, если оно там есть, и делаем курсивом
-                clean_desc = desc.replace("Состав: ", "").strip()
-                item_text += f"\n     <i>└ {clean_desc}</i>"
+# Просмотр корзины
+@route("view_cart")
+async def cb_view_cart(call: CallbackQuery, state: FSMContext):
+    text, kb = await render_cart(call.from_user.id)
+    await call.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    await call.answer()
 
-            lines.append(item_text)
+# Логика кнопки "Изменить букет"
+@route("edit_bouquet", int)
+async def cb_edit_bouquet(call: CallbackQuery, state: FSMContext, pid_to_edit: int):
+    user_id = call.from_user.id
 
-        text = "<b>🧺 Ваша корзина:</b>\n\n" + "\n\n".join(
-            lines) + f"\n\n💰 Итого к оплате: <b>{total} ₽</b>\n\nМы приготовим всё красиво и аккуратно — осталось оформить."
-        await call.message.edit_text(text, reply_markup=cart_kb(items), parse_mode="HTML")
-        await call.answer()
-        return
+    # Состав берем из bouquet_items — один индексированный запрос
+    composition = (await get_bouquet_items([pid_to_edit]))[pid_to_edit]
+    new_draft = {pid: qty for pid, _, qty, _ in composition}
 
-    # Логика кнопки "Изменить букет"
-    if data.startswith("edit_bouquet_"):
-        try:
-            pid_to_edit = int(data.split("_")[2])
-        except:
+    if not new_draft:
+        # Букеты, собранные до появления bouquet_items, — разбираем старое текстовое описание
+        row = await db.fetchone("SELECT description FROM products WHERE id = ?", (pid_to_edit,))
+        if not row:
+            await call.answer("Товар не найден", show_alert=True)
             return
 
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute("SELECT description FROM products WHERE id = ?", (pid_to_edit,))
-            row = await cur.fetchone()
-            if not row:
-                await call.answer("Товар не найден", show_alert=True)
-                return
-
-            description = row[0]
+        description = row[0] or ""
+        ids_by_name = {name: pid for pid, name, *_ in await catalog.products("lonely")}
 
-            # Очищаем черновик
-            await db.execute("DELETE FROM bouquet_draft WHERE user_id = ?", (user_id,))
-
-            # Парсим состав
-            try:
-                composition_part = description.split("Состав: ")[-1].split(".")[0]
-                items_str = [s.strip() for s in composition_part.split(",")]
-
-                for item_str in items_str:
-                    if "(" in item_str and ")" in item_str:
-                        flower_name = item_str.split(" (")[0]
-                        qty_str = item_str.split(" (")[1].replace(")", "")
-
-                        if qty_str.isdigit():
-                            qty = int(qty_str)
-                            cur = await db.execute("SELECT id FROM products WHERE name = ?", (flower_name,))
-                            prod_row = await cur.fetchone()
-                            if prod_row:
-                                real_prod_id = prod_row[0]
-                                await db.execute(
-                                    "INSERT INTO bouquet_draft (user_id, product_id, quantity) VALUES (?, ?, ?)",
-                                    (user_id, real_prod_id, qty))
-            except Exception:
-                pass
-
-            await db.commit()
-
-        # --- ИСПРАВЛЕНИЕ ---
-        # Мы НЕ удаляем старый букет из корзины здесь.
-        # Мы просто запоминаем ID редактируемого букета в user_states.
-        # Если пользователь нажмет "Назад", букет останется в корзине.
-        # Если нажмет "Упаковать", мы удалим старый ID в блоке pack_yes/no.
-        if user_id not in user_states:
-            user_states[user_id] = {}
-        user_states[user_id]['editing_pid'] = pid_to_edit
-
-        # Переходим в меню создания
-        await show_creation_menu(call.message, user_id)
-        await call.answer()
-        return
+        # Парсим состав
+        try:
+            composition_part = description.split("Состав: ")[-1].split(".")[0]
+            items_str = [s.strip() for s in composition_part.split(",")]
 
-    # Очистить корзину
-    if data == "clear_cart":
-        await clear_cart(user_id)
-        kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="main_menu")]])
-        await call.message.edit_text("🧹 Корзина очищена — можно начать заново.", reply_markup=kb)
-        await call.answer(text="Корзина очищена")
-        return
+            for item_str in items_str:
+                if "(" in item_str and ")" in item_str:
+                    flower_name = item_str.split(" (")[0]
+                    qty_str = item_str.split(" (")[1].replace(")", "")
 
-    if data.startswith("remove_"):
-        try:
-            pid = int(data.split("_", 1)[1])
+                    if qty_str.isdigit() and flower_name in ids_by_name:
+                        new_draft[ids_by_name[flower_name]] = int(qty_str)
         except Exception:
-            await call.answer("Неверные данные", show_alert=True)
-            return
-
-        await remove_one_from_cart(user_id, pid)
+            pass
 
-        # Обновляем отображение корзины
-        items = await get_cart(user_id)
-        if not items:
-            kb = InlineKeyboardMarkup(
-                inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="main_menu")]])
-            await call.message.edit_text("🧺 Ваша корзина пуста.", reply_markup=kb)
-            await call.answer()
-            return
+    drafts.replace(user_id, new_draft)
 
-        # ИСПРАВЛЕНИЕ ЗДЕСЬ: распаковываем 6 переменных (или используем *_)
-        lines = []
-        total = 0
-        for pid, name, price, qty, desc, p_type in items:
-            lines.append(f"{name} — {price} ₽ × {qty} = {price * qty} ₽")
-            total += price * qty
+    # --- ИСПРАВЛЕНИЕ ---
+    # Мы НЕ удаляем старый букет из корзины здесь.
+    # Мы просто запоминаем ID редактируемого букета в сессии пользователя.
+    # Если пользователь нажмет "Назад", букет останется в корзине.
+    # Если нажмет "Упаковать", мы удалим старый ID в блоке pack_yes/no.
+    await sessions.update(user_id, editing_pid=pid_to_edit)
 
-        text = "<b>🧺 Ваша корзина:</b>\n\n" + "\n".join(lines) + f"\n\nИтого: <b>{total} ₽</b>"
-        await call.message.edit_text(text, reply_markup=cart_kb(items), parse_mode="HTML")
-        await call.answer(text="Удалено")
-        return
+    # Переходим в меню создания
+    await show_creation_menu(call.message, user_id)
+    await call.answer()
 
-        # Добавить готовый букет (нажатие на кнопку в меню)
-    if data.startswith("plus_bouquet_"):
-        try:
-            pid = int(data.replace("plus_bouquet_", ""))
-        except Exception:
-            return
+# Очистить корзину
+@route("clear_cart")
+async def cb_clear_cart(call: CallbackQuery, state: FSMContext):
+    await clear_cart(call.from_user.id)
+    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="main_menu")]])
+    await call.message.edit_text("🧹 Корзина очищена — можно начать заново.", reply_markup=kb)
+    await call.answer(text="Корзина очищена")
 
-        await add_to_cart(user_id, pid, 1)
-        await call.answer("✅ Добавлено в корзину!", show_alert=False)
+@route("remove", int)
+async def cb_remove(call: CallbackQuery, state: FSMContext, pid: int):
+    user_id = call.from_user.id
+    await remove_one_from_cart(user_id, pid)
+
+    # Обновляем отображение корзины
+    text, kb = await render_cart(user_id)
+    await call.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    await call.answer(text="Удалено")
+
+# Добавить готовый букет (нажатие на кнопку в меню)
+@route("plus_bouquet", int)
+async def cb_plus_bouquet(call: CallbackQuery, state: FSMContext, pid: int):
+    if not await add_to_cart(call.from_user.id, pid, 1):
+        await call.answer(PRODUCT_GONE_TEXT, show_alert=True)
         return
+    await call.answer("✅ Добавлено в корзину!", show_alert=False)
 
-    if data == 'addr_confirm_yes':
-        # Данные уже сохранены в temp_address, переходим ко времени
-        await state.set_state(OrderState.waiting_for_time)
+@route("addr_confirm_yes")
+async def cb_addr_confirm_yes(call: CallbackQuery, state: FSMContext):
+    # Данные уже сохранены в temp_address, переходим ко времени
+    await state.set_state(OrderState.waiting_for_time)
 
-        await call.message.edit_text(
-            "✅ Адрес сохранён!\n\n"
-            "Теперь напишите, к какому <b>времени и дате</b> нужно доставить букет?\n"
-            "<i>(Например: Завтра к 18:00)</i>",
-            parse_mode="HTML"
-        )
-        await call.answer()
-        return
-    # По умолчанию — acknowledge
+    await call.message.edit_text(
+        "✅ Адрес сохранён!\n\n"
+        "Теперь напишите, к какому <b>времени и дате</b> нужно доставить букет?\n"
+        "<i>(Например: Завтра к 18:00)</i>",
+        parse_mode="HTML"
+    )
     await call.answer()
 
+@dp.callback_query()
+async def generic_callback(call: CallbackQuery, state: FSMContext):
+    # Поиск действия в таблице маршрутов — O(1), сколько бы кнопок ни было
+    if not await callback_router.dispatch(call, state):
+        # По умолчанию — acknowledge
+        await call.answer()
 
 
 # ==========================================
@@ -1187,33 +1247,65 @@ async def process_time_input(message: Message, state: FSMContext):
 @dp.message()
 async def fallback_message(message: Message):
     user_id = message.from_user.id
-    if user_id in user_states and 'waiting_for_qty' in user_states[user_id]:
-        pid = user_states[user_id]['waiting_for_qty']
-        name = user_states[user_id]['product_name']
+    session = await sessions.get(user_id)
+    if 'waiting_for_qty' in session:
+        pid = session['waiting_for_qty']
+        name = session['product_name']
         try:
             qty = int(message.text.strip())
             if qty <= 0:
                 await message.answer("Количество должно быть положительным целым числом. 🌸")
                 return
-            await add_to_cart(user_id, pid, qty)
+            if not await add_to_cart(user_id, pid, qty):
+                await message.answer(PRODUCT_GONE_TEXT)
+                return
             await message.answer(f"Добавлено {qty} шт. «{name}» в корзину! 🌷 Вы можете продолжить выбор или перейти в корзину.")
         except ValueError:
             await message.answer("Пожалуйста, введите целое число. 🌿")
             return
         finally:
-            user_states.pop(user_id, None)
+            await sessions.discard(user_id, 'waiting_for_qty', 'product_name')
     else:
         await message.answer("Привет! Отправь /start чтобы открыть каталог 🌿\n\nЕсли нужно быстро связаться с нами — напиши здесь сообщение, и мы ответим как можно скорее. 💌")
 
 # --------- Запуск ---------
 async def main():
+    await db.connect()
     await init_db()
-    print(f"{datetime.now().isoformat()} — Бот запускается")
+    await payment_services.crypto_client.start()
+    send_scheduler.start()
+    metrics_server = MetricsServer(metrics)
+    await metrics_server.start()
+    drafts.start()
+    fsm_storage.start()
+    compactor.start()
+    admin_outbox.start()
+    crypto_poller.start()
+    # Фото каталога загружаем в служебный чат в фоне, чтобы не задерживать старт
+    prewarm_task = asyncio.create_task(photos.prewarm_photos(bot, catalog))
+    logger.info(f"Бот запускается ({BOT_MODE})")
     try:
-        await dp.start_polling(bot)
+        if BOT_MODE == "webhook":
+            await WebhookServer(dp, bot).run()
+        else:
+            # Если раньше работали через webhook — снимаем его, иначе getUpdates вернет конфликт
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     finally:
+        prewarm_task.cancel()
+        await compactor.stop()
+        await fsm_storage.stop()
+        await crypto_poller.stop()
+        await admin_outbox.stop()
+        await edit_coalescer.stop()
+        await send_scheduler.stop()
+        await metrics_server.stop()
         await bot.session.close()
+        await payment_services.crypto_client.close()
+        await drafts.stop()
+        await db.close()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=LOG_LEVEL.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     asyncio.run(main())
@@ -0,0 +1,234 @@
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from aiogram.types import TelegramObject
+
+from database import Database, tag_queries
+
+logger = logging.getLogger(__name__)
+
+# Локальный адрес для Prometheus (пустой порт — не поднимать)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = os.getenv("METRICS_PORT", "8081")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Метки текущего обновления (имя обработчика и т.п.) — заполняются по ходу обработки
+_update_labels: ContextVar[Optional[Dict[str, str]]] = ContextVar("update_labels", default=None)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def set_label(**labels: str):
+    """Уточнить метки текущего обновления (например, действие кнопки внутри generic_callback)."""
+    current = _update_labels.get()
+    if current is not None:
+        current.update(labels)
+    if "handler" in labels:
+        # SQL обновления тоже относим к этому обработчику
+        tag_queries(labels["handler"])
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами (накопительная, как в Prometheus)."""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Реестр метрик бота: счетчики, гистограммы задержек и «живые» значения (gauge) через функции.
+    render() отдает все в текстовом формате Prometheus.
+    """
+
+    def __init__(self):
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._gauges: Dict[str, Callable[[], Dict[Labels, float]]] = {}
+        self._help: Dict[str, str] = {}
+        self.in_flight = 0
+        self.gauge("bot_updates_in_flight", "Updates being processed right now",
+                   lambda: {(): self.in_flight})
+
+    def inc(self, name: str, help_text: str, labels: Labels = (), value: float = 1):
+        self._help.setdefault(name, help_text)
+        series = self._counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name: str, help_text: str, labels: Labels, value: float):
+        self._help.setdefault(name, help_text)
+        series = self._histograms.setdefault(name, {})
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name: str, help_text: str, collect: Callable[[], Dict[Labels, float]]):
+        """collect() вызывается при каждом запросе /metrics и возвращает {метки: значение}."""
+        self._help[name] = help_text
+        self._gauges[name] = collect
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for name, series in self._counters.items():
+            lines += [f"# HELP {name} {self._help[name]}", f"# TYPE {name} counter"]
+            lines += [f"{name}{_format_labels(labels)} {value}" for labels, value in series.items()]
+        for name, series in self._histograms.items():
+            lines += [f"# HELP {name} {self._help[name]}", f"# TYPE {name} histogram"]
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        for name, collect in self._gauges.items():
+            try:
+                values = collect()
+            except Exception as e:
+                logger.error(f"Metric {name} collection failed: {e}")
+                continue
+            lines += [f"# HELP {name} {self._help[name]}", f"# TYPE {name} gauge"]
+            lines += [f"{name}{_format_labels(labels)} {value}" for labels, value in values.items()]
+        return "\n".join(lines) + "\n"
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """
+    Внешний middleware на dp.update: время обработки каждого обновления, исход и число обновлений в работе.
+    Метку handler проставляют HandlerLabelMiddleware и роутер кнопок (set_label).
+    Если передана db — еще число SQL-выражений и время в БД на обновление.
+    """
+
+    def __init__(self, metrics: Metrics, db: Optional[Database] = None):
+        self.metrics = metrics
+        self.db = db
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        labels = {"handler": "unhandled"}
+        token = _update_labels.set(labels)
+        self.metrics.in_flight += 1
+        started = time.perf_counter()
+        outcome = "ok"
+        with (self.db.scope(labels["handler"]) if self.db is not None else nullcontext()) as queries:
+            try:
+                result = await handler(event, data)
+                if result is UNHANDLED:
+                    outcome = "unhandled"
+                return result
+            except Exception:
+                outcome = "error"
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                self.metrics.in_flight -= 1
+                _update_labels.reset(token)
+                key = (("handler", labels["handler"]),)
+                self.metrics.observe("bot_update_duration_seconds", "Update processing time by handler", key, elapsed)
+                self.metrics.inc("bot_updates_total", "Processed updates by handler and outcome",
+                                 key + (("outcome", outcome),))
+                if queries is not None:
+                    self.metrics.inc("bot_db_statements_total", "SQL statements executed by handler", key,
+                                     queries.statements)
+                    self.metrics.observe("bot_update_db_seconds", "Time spent in SQLite per update by handler",
+                                         key, queries.seconds)
+
+
+class HandlerLabelMiddleware(BaseMiddleware):
+    """Внутренний middleware (на dp.message / dp.callback_query / ...): запоминает, какой обработчик выбран."""
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        handler_object = data.get("handler")
+        if handler_object is not None:
+            set_label(handler=getattr(handler_object.callback, "__name__", "handler"))
+        return await handler(event, data)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: число вызовов Telegram API, ошибки и задержка по методам."""
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot: Bot,
+                       method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        labels = (("method", type(method).__name__),)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            self.metrics.inc("telegram_api_errors_total", "Failed Telegram API calls by method and error",
+                             labels + (("error", type(e).__name__),))
+            raise
+        finally:
+            self.metrics.inc("telegram_api_calls_total", "Telegram API calls by method", labels)
+            self.metrics.observe("telegram_api_duration_seconds", "Telegram API call time by method", labels,
+                                 time.perf_counter() - started)
+
+
+class MetricsServer:
+    """Локальный HTTP-эндпоинт /metrics для Prometheus."""
+
+    def __init__(self, metrics: Metrics, host: str = METRICS_HOST, port: Optional[str] = METRICS_PORT):
+        self.metrics = metrics
+        self.host = host
+        self.port = int(port) if port else None
+        self._runner: Optional[web.AppRunner] = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.metrics.render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self):
+        if not self.port:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self.host, self.port).start()
+        except OSError as e:
+            # Занятый порт не должен мешать боту работать
+            logger.error(f"Metrics endpoint is not available on {self.host}:{self.port}: {e}")
+            await self._runner.cleanup()
+            self._runner = None
+            return
+        logger.info(f"Metrics endpoint: http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,245 @@
+import hashlib
+import logging
+from typing import Awaitable, Callable, List, Sequence, Tuple
+
+import aiosqlite
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Начальный каталог: новые товары добавляются, у существующих обновляется только картинка
+# (file_id сбрасываем, только если сама ссылка поменялась)
+SEED_PRODUCTS_SQL = """
+INSERT INTO products (name, price, description, type, image) VALUES {values}
+ON CONFLICT(name) DO UPDATE SET
+    image_file_id = CASE WHEN image = excluded.image THEN image_file_id END,
+    image = excluded.image
+"""
+
+# (название, цена, описание, тип, ссылка на фото)
+SeedProduct = Tuple[str, int, str, str, str]
+Step = Callable[[aiosqlite.Connection], Awaitable[None]]
+
+
+def sql_step(*statements: str) -> Step:
+    """Шаг миграции из готовых SQL-выражений."""
+    async def step(conn: aiosqlite.Connection):
+        for sql in statements:
+            await conn.execute(sql)
+    return step
+
+
+async def add_column(conn: aiosqlite.Connection, table: str, column: str, decl: str):
+    """ALTER TABLE ADD COLUMN, если колонки еще нет (базы до версионирования могли ее уже получить)."""
+    cur = await conn.execute(f"PRAGMA table_info({table})")
+    columns = {row[1] for row in await cur.fetchall()}
+    await cur.close()
+    if column not in columns:
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+async def _product_images(conn: aiosqlite.Connection):
+    await add_column(conn, "products", "image", "TEXT")
+    # file_id фото в Telegram (чтобы не качать картинку по ссылке каждый раз)
+    await add_column(conn, "products", "image_file_id", "TEXT")
+
+
+async def _order_payment_ref(conn: aiosqlite.Connection):
+    # Идентификатор оплаты (инвойс CryptoPay, платеж Telegram): по одной оплате — не больше одного заказа
+    await add_column(conn, "orders", "payment_ref", "TEXT")
+    await conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_payment_ref ON orders(payment_ref) WHERE payment_ref IS NOT NULL"
+    )
+
+
+# Шаги по порядку: номер версии = позиция в списке + 1. Уже выпущенные шаги не меняем — только дописываем новые.
+# SQL шагов записан здесь же, а не берется из модулей: правка живого кода не должна менять выпущенную миграцию.
+# Все шаги идемпотентны: базы, созданные до версионирования (user_version = 0), проходят их без ошибок.
+MIGRATIONS: List[Tuple[str, Step]] = [
+    ("base tables", sql_step(
+        """
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            price INTEGER NOT NULL,
+            description TEXT,
+            type TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS cart (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL DEFAULT 1,
+            UNIQUE(user_id, product_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS bouquet_draft (
+            user_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL DEFAULT 1,
+            UNIQUE(user_id, product_id)
+        )
+        """,
+        # Состав собранных букетов (type = created_bouquet): цена фиксируется на момент сборки
+        """
+        CREATE TABLE IF NOT EXISTS bouquet_items (
+            bouquet_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            unit_price INTEGER NOT NULL,
+            PRIMARY KEY (bouquet_id, product_id)
+        )
+        """,
+        # Чтение каталога по типу и поиск ссылок на букет из корзины (для сборки мусора)
+        "CREATE INDEX IF NOT EXISTS idx_products_type ON products(type)",
+        "CREATE INDEX IF NOT EXISTS idx_cart_product ON cart(product_id)",
+    )),
+    ("product images", _product_images),
+    ("fsm storage", sql_step(
+        """
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm_storage(updated_at)",
+    )),
+    ("orders", sql_step(
+        """
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'new',
+            payment_label TEXT NOT NULL,
+            address TEXT,
+            delivery_time TEXT,
+            total INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )
+        """,
+        # Снимок позиций на момент заказа: название и цена не меняются, даже если товар потом правят
+        """
+        CREATE TABLE IF NOT EXISTS order_items (
+            order_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            unit_price INTEGER NOT NULL,
+            PRIMARY KEY (order_id, product_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at)",
+        # Для сборки мусора: букет из заказа удалять нельзя
+        "CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items(product_id)",
+    )),
+    ("admin outbox", sql_step(
+        """
+        CREATE TABLE IF NOT EXISTS admin_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT NOT NULL,
+            text TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON admin_outbox(next_attempt_at)",
+    )),
+    # Служебные значения схемы (отпечаток начального каталога и т.п.)
+    ("schema meta", sql_step(
+        """
+        CREATE TABLE IF NOT EXISTS schema_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        """,
+    )),
+    # Полнотекстовый индекс по названию и описанию товаров витрины (external content: текст хранится только в products).
+    # Триггеры держат индекс в синхронизации с любой записью в products; собранные пользователями букеты не индексируются
+    ("product search", sql_step(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5("
+        "name, description, content='products', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        """
+        CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products
+        WHEN new.type IN ('bouquet', 'lonely') BEGIN
+            INSERT INTO products_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products
+        WHEN old.type IN ('bouquet', 'lonely') BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+        END
+        """,
+        # Одним триггером: сначала убрать старый текст, потом добавить новый (порядок разных триггеров не гарантирован)
+        """
+        CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, description, type ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description)
+            SELECT 'delete', old.id, old.name, old.description WHERE old.type IN ('bouquet', 'lonely');
+            INSERT INTO products_fts (rowid, name, description)
+            SELECT new.id, new.name, new.description WHERE new.type IN ('bouquet', 'lonely');
+        END
+        """,
+        # Товары, которые уже есть в базе
+        "INSERT INTO products_fts (products_fts) VALUES ('delete-all')",
+        "INSERT INTO products_fts (rowid, name, description) "
+        "SELECT id, name, description FROM products WHERE type IN ('bouquet', 'lonely')",
+    )),
+    ("order payment ref", _order_payment_ref),
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def seed_fingerprint(seed: Sequence[SeedProduct]) -> str:
+    return hashlib.sha1(repr(list(seed)).encode()).hexdigest()
+
+
+async def _seed_products(conn: aiosqlite.Connection, seed: Sequence[SeedProduct], fingerprint: str):
+    # Один upsert на весь каталог вместо INSERT/UPDATE на каждый товар
+    values = ", ".join(["(?, ?, ?, ?, ?)"] * len(seed))
+    await conn.execute(SEED_PRODUCTS_SQL.format(values=values), [field for product in seed for field in product])
+    await conn.execute(
+        "INSERT INTO schema_meta (key, value) VALUES ('seed', ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (fingerprint,)
+    )
+
+
+async def migrate(db: Database, seed: Sequence[SeedProduct] = ()) -> int:
+    """
+    Доводит схему до SCHEMA_VERSION и заливает начальный каталог. Возвращает версию схемы.
+    Если схема актуальна и каталог не менялся — два чтения и никаких записей.
+    """
+    fingerprint = seed_fingerprint(seed)
+    row = await db.fetchone("PRAGMA user_version")
+    if row[0] >= SCHEMA_VERSION:
+        if row[0] > SCHEMA_VERSION:
+            logger.warning(f"Database schema v{row[0]} is newer than this code (v{SCHEMA_VERSION})")
+        stored = await db.fetchone("SELECT value FROM schema_meta WHERE key = 'seed'")
+        if not seed or (stored and stored[0] == fingerprint):
+            return row[0]
+
+    async with db.transaction() as conn:
+        # Перечитываем под блокировкой писателя: миграции могли пройти, пока мы ждали
+        cur = await conn.execute("PRAGMA user_version")
+        version = (await cur.fetchone())[0]
+        await cur.close()
+        for number, (name, step) in enumerate(MIGRATIONS[version:], version + 1):
+            logger.info(f"Applying migration {number}: {name}")
+            await step(conn)
+            # user_version лежит в заголовке файла и меняется вместе с транзакцией
+            await conn.execute(f"PRAGMA user_version = {number}")
+        if seed:
+            await _seed_products(conn, seed, fingerprint)
+    return max(version, SCHEMA_VERSION)
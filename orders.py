@@ -0,0 +1,118 @@
+import time
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+from database import Database
+
+# (id, name, price, qty, description, type) — как в get_cart
+CartRow = Tuple[int, str, int, int, Optional[str], str]
+
+# Отсчет для номеров заказов (2024-01-01 UTC), чтобы номера были короче
+ORDER_ID_EPOCH_MS = 1704067200000
+ORDER_ID_SEQ_BITS = 10
+
+
+class OrderIdGenerator:
+    """
+    Номера заказов: миллисекунды от ORDER_ID_EPOCH_MS, сдвинутые на ORDER_ID_SEQ_BITS, плюс счетчик внутри миллисекунды.
+    Номера растут строго монотонно (даже если часы откатились назад) и упорядочены по времени,
+    поэтому совпасть не могут, а сортировка по id — это сортировка по времени создания.
+    """
+
+    def __init__(self):
+        self._last = 0
+
+    def seed(self, last_id: Optional[int]):
+        """Продолжаем после последнего номера из базы — после рестарта номера не повторятся."""
+        if last_id:
+            self._last = max(self._last, last_id)
+
+    def next(self) -> int:
+        candidate = (int(time.time() * 1000) - ORDER_ID_EPOCH_MS) << ORDER_ID_SEQ_BITS
+        self._last = max(candidate, self._last + 1)
+        return self._last
+
+
+order_ids = OrderIdGenerator()
+
+
+async def init_order_ids(db: Database):
+    row = await db.fetchone("SELECT MAX(id) FROM orders")
+    order_ids.seed(row[0] if row else None)
+
+
+async def place_order(db: Database, user_id: int, chat_id: int, payment_label: str,
+                      address: str, delivery_time: str, payment_ref: Optional[str] = None,
+                      on_placed: Optional[Callable[[Any, int, List[CartRow]], Awaitable[None]]] = None
+                      ) -> Optional[Tuple[int, List[CartRow]]]:
+    """
+    Переносит корзину в заказ одной транзакцией: читаем корзину, пишем orders + order_items, очищаем корзину.
+    on_placed(conn, номер, позиции) выполняется в той же транзакции (например, запись уведомления в admin_outbox).
+    payment_ref — идентификатор оплаты: уникальный индекс не даст оформить по одной оплате второй заказ.
+    Возвращает (номер заказа, позиции) или None, если корзина пуста (например, заказ уже оформлен).
+    """
+    async with db.transaction() as conn:
+        cur = await conn.execute("""
+            SELECT p.id, p.name, p.price, c.quantity, p.description, p.type
+            FROM cart c
+            JOIN products p ON p.id = c.product_id
+            WHERE c.user_id = ?
+            ORDER BY p.id
+        """, (user_id,))
+        items = await cur.fetchall()
+        await cur.close()
+        if not items:
+            return None
+
+        order_id = order_ids.next()
+        total = sum(price * qty for _, _, price, qty, _, _ in items)
+        await conn.execute("""
+            INSERT INTO orders (id, user_id, chat_id, status, payment_label, address, delivery_time, total, created_at,
+                                payment_ref)
+            VALUES (?, ?, ?, 'new', ?, ?, ?, ?, ?, ?)
+        """, (order_id, user_id, chat_id, payment_label, address, delivery_time, total, time.time(), payment_ref))
+        await conn.executemany(
+            "INSERT INTO order_items (order_id, product_id, name, quantity, unit_price) VALUES (?, ?, ?, ?, ?)",
+            [(order_id, pid, name, qty, price) for pid, name, price, qty, _, _ in items]
+        )
+        await conn.execute("DELETE FROM cart WHERE user_id = ?", (user_id,))
+        if on_placed is not None:
+            await on_placed(conn, order_id, items)
+    return order_id, items
+
+
+async def get_order(db: Database, order_id: int):
+    """Заказ по номеру (для поддержки): (заказ, [(product_id, name, qty, unit_price)]) или None."""
+    order = await db.fetchone("""
+        SELECT id, user_id, chat_id, status, payment_label, address, delivery_time, total, created_at
+        FROM orders WHERE id = ?
+    """, (order_id,))
+    if order is None:
+        return None
+    items = await db.fetchall(
+        "SELECT product_id, name, quantity, unit_price FROM order_items WHERE order_id = ? ORDER BY rowid",
+        (order_id,)
+    )
+    return order, items
+
+
+async def find_paid_order(db: Database, payment_ref: str) -> Optional[int]:
+    """Номер заказа, уже оформленного по этой оплате, или None."""
+    row = await db.fetchone("SELECT id FROM orders WHERE payment_ref = ?", (payment_ref,))
+    return row[0] if row else None
+
+
+async def get_user_orders(db: Database, user_id: int, limit: int = 10):
+    """Последние заказы пользователя (новые первыми)."""
+    return await db.fetchall("""
+        SELECT id, status, total, created_at FROM orders
+        WHERE user_id = ? ORDER BY created_at DESC LIMIT ?
+    """, (user_id, limit))
+
+
+async def get_orders_summary(db: Database, start: float, end: float):
+    """Отчет за период [start, end): [(status, число заказов, выручка)]."""
+    return await db.fetchall("""
+        SELECT status, COUNT(*), SUM(total) FROM orders
+        WHERE created_at >= ? AND created_at < ?
+        GROUP BY status ORDER BY status
+    """, (start, end))
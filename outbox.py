@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import os
+import time
+from typing import List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+
+from database import Database
+from ratelimit import background
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждем «хвост» пачки после первого сообщения и сколько сообщений склеиваем за раз
+OUTBOX_BATCH_WINDOW = float(os.getenv("OUTBOX_BATCH_WINDOW", "1"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", "2"))
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", "600"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "20"))
+# Лимит Telegram на длину сообщения
+MESSAGE_LIMIT = 4096
+
+DIGEST_SEPARATOR = "\n\n〰〰〰〰〰〰〰\n\n"
+
+
+class AdminOutbox:
+    """
+    Надежная доставка отчетов админу.
+    add() только пишет сообщение в таблицу admin_outbox в транзакции вызывающего (вместе с заказом),
+    wake() после COMMIT будит отправщика — оформление заказа не ждет Telegram.
+    Фоновый отправщик забирает накопившиеся сообщения: одно уходит как есть, несколько — склеиваются
+    в дайджест. При ошибке сообщение остается в таблице и повторяется с экспоненциальной задержкой
+    (на RetryAfter — ровно столько, сколько просит Telegram). Неотправленное переживает рестарт.
+    """
+
+    def __init__(self, db: Database, bot: Bot, chat_id: Optional[str],
+                 batch_window: float = OUTBOX_BATCH_WINDOW, batch_size: int = OUTBOX_BATCH_SIZE):
+        self.db = db
+        self.bot = bot
+        self.chat_id = chat_id
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.digests = 0
+        self.failures = 0
+
+    async def add(self, conn, text: str):
+        """Записать сообщение внутри чужой транзакции (вместе с заказом). После COMMIT вызвать wake()."""
+        if not self.chat_id:
+            return
+        now = time.time()
+        await conn.execute(
+            "INSERT INTO admin_outbox (chat_id, text, created_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+            (str(self.chat_id), text, now, now)
+        )
+
+    def wake(self):
+        self._wakeup.set()
+
+    # --------- Отправка ---------
+    def _chunks(self, rows: List[Tuple[int, str]]) -> List[Tuple[List[int], str]]:
+        """Склеивает сообщения в дайджесты, не превышая лимит Telegram на длину."""
+        chunks: List[Tuple[List[int], str]] = []
+        ids: List[int] = []
+        parts: List[str] = []
+        size = 0
+        for row_id, text in rows:
+            extra = len(text) + (len(DIGEST_SEPARATOR) if parts else 0)
+            if parts and size + extra > MESSAGE_LIMIT - 64:
+                chunks.append((ids, self._render(parts)))
+                ids, parts, size = [], [], 0
+                extra = len(text)
+            ids.append(row_id)
+            parts.append(text)
+            size += extra
+        if parts:
+            chunks.append((ids, self._render(parts)))
+        return chunks
+
+    @staticmethod
+    def _render(parts: List[str]) -> str:
+        if len(parts) == 1:
+            return parts[0]
+        return f"📦 <b>Дайджест: {len(parts)} сообщений</b>{DIGEST_SEPARATOR}" + DIGEST_SEPARATOR.join(parts)
+
+    async def _fail(self, ids: List[int], error: str, delay: Optional[float] = None):
+        self.failures += 1
+        placeholders = ", ".join("?" for _ in ids)
+        if delay is None:
+            # Экспоненциальная задержка по числу попыток, но не больше OUTBOX_RETRY_MAX
+            await self.db.execute(f"""
+                UPDATE admin_outbox
+                SET attempts = attempts + 1, last_error = ?,
+                    next_attempt_at = ? + MIN(? * (1 << MIN(attempts, 16)), ?)
+                WHERE id IN ({placeholders})
+            """, (error, time.time(), OUTBOX_RETRY_BASE, OUTBOX_RETRY_MAX, *ids))
+        else:
+            await self.db.execute(f"""
+                UPDATE admin_outbox SET attempts = attempts + 1, last_error = ?, next_attempt_at = ?
+                WHERE id IN ({placeholders})
+            """, (error, time.time() + delay, *ids))
+
+    async def dispatch_once(self) -> int:
+        """Отправляет все сообщения, которым пора уйти. Возвращает число доставленных."""
+        rows = await self.db.fetchall("""
+            SELECT id, chat_id, text FROM admin_outbox
+            WHERE next_attempt_at <= ? AND attempts < ?
+            ORDER BY id LIMIT ?
+        """, (time.time(), OUTBOX_MAX_ATTEMPTS, self.batch_size))
+        delivered = 0
+        by_chat = {}
+        for row_id, chat_id, text in rows:
+            by_chat.setdefault(chat_id, []).append((row_id, text))
+
+        for chat_id, chat_rows in by_chat.items():
+            for ids, text in self._chunks(chat_rows):
+                try:
+                    await self.bot.send_message(chat_id, text, parse_mode="HTML")
+                except TelegramRetryAfter as e:
+                    await self._fail(ids, str(e), delay=e.retry_after)
+                    return delivered
+                except Exception as e:
+                    logger.error(f"Admin outbox delivery failed ({len(ids)} messages): {e}")
+                    await self._fail(ids, str(e))
+                    continue
+                placeholders = ", ".join("?" for _ in ids)
+                await self.db.execute(f"DELETE FROM admin_outbox WHERE id IN ({placeholders})", ids)
+                delivered += len(ids)
+                self.sent += 1
+                if len(ids) > 1:
+                    self.digests += 1
+        return delivered
+
+    async def _next_due_in(self) -> Optional[float]:
+        row = await self.db.fetchone(
+            "SELECT MIN(next_attempt_at) FROM admin_outbox WHERE attempts < ?", (OUTBOX_MAX_ATTEMPTS,)
+        )
+        if not row or row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    async def _run(self):
+        # Отчеты админу не должны тормозить ответы покупателям
+        with background():
+            await self._loop()
+
+    async def _loop(self):
+        while True:
+            try:
+                # Даем пачке заказов накопиться, чтобы отправить её одним дайджестом
+                await asyncio.sleep(self.batch_window)
+                # Сбрасываем до выборки: что добавят во время отправки, разбудит нас снова
+                self._wakeup.clear()
+                while await self.dispatch_once() >= self.batch_size:
+                    pass
+                timeout = await self._next_due_in()
+            except Exception as e:
+                logger.error(f"Admin outbox error: {e}")
+                timeout = OUTBOX_RETRY_BASE
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Неотправленное остается в admin_outbox и уйдет после следующего запуска
+        logger.info(f"Admin outbox stats: sent={self.sent} digests={self.digests} failures={self.failures}")
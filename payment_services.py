@@ -1,9 +1,9 @@
 import aiohttp
 from dotenv import load_dotenv
 import os
-from typing import Optional, List, Tuple, Union, Dict, Set
+import time
+from typing import Optional, List, Tuple, Union, Dict, Set, Any, Callable, Awaitable
 import logging
-import requests
 import asyncio
 
 load_dotenv()
@@ -16,68 +16,241 @@ CRYPTOPAY_TOKEN = os.getenv("CRYPTOPAY_TOKEN")
 CRYPTOPAY_BASE = "https://testnet-pay.crypt.bot"
 PORTMONE_TOKEN = os.getenv("PORTMONE_TOKEN")
 
-async def create_crypto_invoice(amount: float, desc: str, payload: str) -> Tuple[
-    Optional[dict], Optional[int], Optional[str]]:
-    """Создает инвойс через CryptoPay API."""
-    headers = {"Crypto-Pay-API-Token": CRYPTOPAY_TOKEN, "Content-Type": "application/json"}
-    body = {
-        "currency_type": "fiat",
-        "fiat": "RUB",
-        "amount": f"{amount:.2f}",
-        "accepted_assets": "USDT",
-        "description": desc,
-        "payload": payload
-    }
-
-    async with aiohttp.ClientSession() as session:  # Создаем сессию
-        for endpoint in ("/api/createInvoice", "/api/create_invoice"):
+# Параметры HTTP-пула для CryptoPay
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "20"))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "60"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+
+# Фоновый опрос статусов инвойсов
+POLL_MIN_INTERVAL = float(os.getenv("CRYPTO_POLL_MIN_INTERVAL", "3"))
+POLL_MAX_INTERVAL = float(os.getenv("CRYPTO_POLL_MAX_INTERVAL", "60"))
+POLL_BATCH_SIZE = 100
+POLL_INVOICE_TTL = float(os.getenv("CRYPTO_POLL_INVOICE_TTL", str(24 * 3600)))
+
+
+class CryptoPayClient:
+    """
+    Клиент CryptoPay с одной долгоживущей aiohttp-сессией.
+    Соединения (TCP+TLS) переиспользуются между запросами, DNS кэшируется.
+    Сессия создается в main() при старте и закрывается при остановке.
+    """
+
+    def __init__(self, token: Optional[str] = CRYPTOPAY_TOKEN, base_url: str = CRYPTOPAY_BASE):
+        self.token = token
+        self.base_url = base_url
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self):
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT,
+            ttl_dns_cache=HTTP_DNS_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE,
+        )
+        self._session = aiohttp.ClientSession(
+            base_url=self.base_url,
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            headers={"Crypto-Pay-API-Token": self.token or ""},
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _post(self, method: str, body: dict) -> Optional[dict]:
+        """POST /api/<method>. Возвращает разобранный JSON или None при ошибке."""
+        if self._session is None or self._session.closed:
+            # На случай вызова до start() (например, из скриптов)
+            await self.start()
+        async with self._session.post(f"/api/{method}", json=body) as r:
+            if r.status != 200:
+                logger.error(f"CryptoPay API Error: {method} status {r.status}, Body: {await r.text()}")
+                return None
+            return await r.json()
+
+    async def create_invoice(self, amount: float, desc: str, payload: str) -> Tuple[
+            Optional[dict], Optional[int], Optional[str]]:
+        body = {
+            "currency_type": "fiat",
+            "fiat": "RUB",
+            "amount": f"{amount:.2f}",
+            "accepted_assets": "USDT",
+            "description": desc,
+            "payload": payload
+        }
+        for method in ("createInvoice", "create_invoice"):
             try:
-                async with session.post(CRYPTOPAY_BASE + endpoint, json=body, headers=headers, timeout=10) as r:
-                    if r.status == 200:
-                        j = await r.json()
-                        return j, j['result']['invoice_id'], j['result']['bot_invoice_url']
+                j = await self._post(method, body)
+                if j:
+                    return j, j['result']['invoice_id'], j['result']['bot_invoice_url']
             except Exception as e:
                 logger.error(f"Crypto invoice error: {e}")
         return None, None, None
 
+    async def get_invoices(self, invoice_ids: List[int]) -> Optional[List[dict]]:
+        """Статусы сразу нескольких инвойсов одним запросом (параметр invoice_ids)."""
+        data = await self._post("getInvoices", {"invoice_ids": [int(i) for i in invoice_ids]})
+        if data and data.get('ok') and 'items' in data.get('result', {}):
+            return data['result']['items']
+        return None
+
 
-async def check_crypto_invoice_status(invoice_id: int) -> Optional[str]:
+crypto_client = CryptoPayClient()
+
+
+async def create_crypto_invoice(amount: float, desc: str, payload: str) -> Tuple[
+    Optional[dict], Optional[int], Optional[str]]:
+    """Создает инвойс через CryptoPay API."""
+    return await crypto_client.create_invoice(amount, desc, payload)
+
+
+class InvoicePoller:
     """
-    Асинхронно проверяет статус инвойса через CryptoPay API.
-    Использует run_in_executor, чтобы aiohttp не блокировал основной цикл бота.
+    Фоновый опрос статусов ожидающих оплаты инвойсов CryptoPay.
+    Все отслеживаемые инвойсы проверяются пачками одним запросом getInvoices (invoice_ids).
+    Интервал адаптивный: сразу после создания инвойса опрашиваем часто, потом все реже,
+    при ошибках API — тоже реже. На статус paid вызывается on_paid (ровно один раз на инвойс);
+    если on_paid упал, инвойс возвращается в очередь и оформление повторится на следующем проходе,
+    поэтому on_paid должен быть идемпотентным (finalize_order сверяет номер инвойса с уже оформленными заказами).
     """
-    headers = {"Crypto-Pay-API-Token": CRYPTOPAY_TOKEN}
-    
-    try:
-        # Получаем текущий цикл событий
-        loop = asyncio.get_running_loop()
-        
-        # Запускаем синхронный запрос в отдельном потоке
-        response = await loop.run_in_executor(
-            None,
-            lambda: requests.post(
-                f"{CRYPTOPAY_BASE}/api/getInvoices",
-                json={"invoice_ids": [int(invoice_id)]},
-                headers=headers,
-                timeout=10
-            )
-        )
-        
-        if response.status_code != 200:
-            logger.error(f"CryptoPay API Error: Status {response.status_code}, Body: {response.text}")
+
+    def __init__(self, client: CryptoPayClient, on_paid: Callable[[int, Dict[str, Any]], Awaitable[None]],
+                 min_interval: float = POLL_MIN_INTERVAL, max_interval: float = POLL_MAX_INTERVAL,
+                 batch_size: int = POLL_BATCH_SIZE, ttl: float = POLL_INVOICE_TTL):
+        self.client = client
+        self.on_paid = on_paid
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.batch_size = batch_size
+        self.ttl = ttl
+        self.interval = min_interval
+        # invoice_id -> (контекст заказа, время начала отслеживания)
+        self._pending: Dict[int, Tuple[Dict[str, Any], float]] = {}
+        # Оплаченные инвойсы, заказ по которым оформляется прямо сейчас
+        self._claimed: Dict[int, Tuple[Dict[str, Any], float]] = {}
+        # Последний известный статус: active / paid / expired
+        self._statuses: Dict[int, str] = {}
+        # Когда инвойс перестали отслеживать (оплачен / истек) — чтобы со временем забыть и его статус
+        self._finished: Dict[int, float] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.requests = 0
+
+    def track(self, invoice_id: int, context: Dict[str, Any]):
+        """Начать отслеживать инвойс. context передается в on_paid."""
+        invoice_id = int(invoice_id)
+        self._pending[invoice_id] = (context, time.monotonic())
+        self._statuses.setdefault(invoice_id, "active")
+        # Новый инвойс — возвращаемся к частому опросу
+        self.interval = self.min_interval
+        self._wakeup.set()
+
+    def is_finished(self, invoice_id: int) -> bool:
+        """Заказ по инвойсу уже оформлен (или инвойс истек)."""
+        return int(invoice_id) in self._finished
+
+    def status(self, invoice_id: int) -> Optional[str]:
+        """Локально закэшированный статус (без запроса к API)."""
+        return self._statuses.get(int(invoice_id))
+
+    def claim(self, invoice_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Забирает контекст оплаченного инвойса на время оформления заказа.
+        Пока не вызван complete() или release(), повторный вызов вернет None — заказ не оформится дважды.
+        """
+        entry = self._pending.pop(int(invoice_id), None)
+        if entry is None:
             return None
-        
-        data = response.json()
-        
-        # Безопасное извлечение данных
-        if (data.get('ok') and
-                'result' in data and
-                'items' in data['result'] and
-                len(data['result']['items']) > 0):
-            return data['result']['items'][0]['status']
-        
-        return None
-    
-    except Exception as e:
-        logger.error(f"Crypto status check exception: {e}")
-        return None
\ No newline at end of file
+        self._claimed[int(invoice_id)] = entry
+        return entry[0]
+
+    def complete(self, invoice_id: int):
+        """Заказ оформлен — инвойс больше не отслеживаем."""
+        if self._claimed.pop(int(invoice_id), None) is not None:
+            self._finished[int(invoice_id)] = time.monotonic()
+
+    def release(self, invoice_id: int):
+        """Оформить не удалось — возвращаем инвойс в очередь, следующий проход попробует снова."""
+        entry = self._claimed.pop(int(invoice_id), None)
+        if entry is not None:
+            self._pending[int(invoice_id)] = entry
+            self._wakeup.set()
+
+    async def poll_once(self) -> bool:
+        """Один проход по всем ожидающим инвойсам. Возвращает True, если какой-то статус изменился."""
+        now = time.monotonic()
+        for invoice_id, (_, started) in list(self._pending.items()):
+            if now - started > self.ttl:
+                self._pending.pop(invoice_id, None)
+                self._statuses.pop(invoice_id, None)
+        for invoice_id, finished in list(self._finished.items()):
+            if now - finished > self.ttl:
+                self._finished.pop(invoice_id, None)
+                self._statuses.pop(invoice_id, None)
+
+        ids = list(self._pending)
+        changed = False
+        for i in range(0, len(ids), self.batch_size):
+            batch = ids[i:i + self.batch_size]
+            self.requests += 1
+            items = await self.client.get_invoices(batch)
+            if items is None:
+                raise RuntimeError("getInvoices failed")
+            for item in items:
+                invoice_id = int(item['invoice_id'])
+                status = item.get('status')
+                if self._statuses.get(invoice_id) != status:
+                    changed = True
+                self._statuses[invoice_id] = status
+                if status == 'paid':
+                    context = self.claim(invoice_id)
+                    if context is not None:
+                        try:
+                            await self.on_paid(invoice_id, context)
+                        except Exception as e:
+                            logger.error(f"on_paid failed for invoice {invoice_id}, will retry: {e}")
+                            self.release(invoice_id)
+                        else:
+                            self.complete(invoice_id)
+                elif status == 'expired':
+                    if self._pending.pop(invoice_id, None) is not None:
+                        self._finished[invoice_id] = time.monotonic()
+        return changed
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                # Нечего опрашивать — ждем нового инвойса
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            try:
+                changed = await self.poll_once()
+                self.interval = self.min_interval if changed else min(self.interval * 1.5, self.max_interval)
+            except Exception as e:
+                logger.error(f"Invoice poll error: {e}")
+                self.interval = min(self.interval * 2, self.max_interval)
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
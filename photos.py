@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import os
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, InlineKeyboardMarkup
+
+from catalog import Catalog
+from ratelimit import background
+
+logger = logging.getLogger(__name__)
+
+# Служебный чат, куда при старте один раз загружаются фото каталога (необязательно)
+PHOTO_CACHE_CHAT_ID = os.getenv("PHOTO_CACHE_CHAT_ID")
+
+
+async def send_product_photo(message: Message, catalog: Catalog, product_id: int, img_url: str,
+                             caption: str, reply_markup: InlineKeyboardMarkup, fallback_url: str) -> Message:
+    """
+    Отправляет фото товара. Если file_id уже известен — это один быстрый запрос без скачивания картинки.
+    Иначе шлем по ссылке и запоминаем file_id из ответа.
+    """
+    file_id = catalog.file_id(product_id)
+    if file_id:
+        try:
+            return await message.answer_photo(photo=file_id, caption=caption, reply_markup=reply_markup,
+                                              parse_mode="HTML")
+        except TelegramBadRequest as e:
+            # file_id протух (например, сменили бота) — забываем и грузим заново
+            logger.warning(f"Cached file_id rejected for product {product_id}: {e}")
+            await catalog.remember_file_id(product_id, None)
+
+    try:
+        sent = await message.answer_photo(photo=img_url, caption=caption, reply_markup=reply_markup, parse_mode="HTML")
+    except Exception:
+        # Если ссылка не грузится — шлем заглушку (её file_id за товаром не закрепляем)
+        return await message.answer_photo(photo=fallback_url, caption=caption, reply_markup=reply_markup,
+                                          parse_mode="HTML")
+
+    if sent.photo:
+        await catalog.remember_file_id(product_id, sent.photo[-1].file_id)
+    return sent
+
+
+async def prewarm_photos(bot: Bot, catalog: Catalog, chat_id: Optional[str] = PHOTO_CACHE_CHAT_ID,
+                         delay: float = 0.5) -> int:
+    """Загружает в служебный чат фото товаров, у которых еще нет file_id. Возвращает число загруженных."""
+    if not chat_id:
+        return 0
+
+    with background():
+        uploaded = await _upload_missing(bot, catalog, chat_id, delay)
+    logger.info(f"Photo prewarm: {uploaded} uploaded")
+    return uploaded
+
+
+async def _upload_missing(bot: Bot, catalog: Catalog, chat_id: str, delay: float) -> int:
+    uploaded = 0
+    for pid, name, _, _, _, img in await catalog.all():
+        if not img or catalog.file_id(pid):
+            continue
+        try:
+            msg = await bot.send_photo(chat_id, photo=img, caption=name, disable_notification=True)
+            if msg.photo:
+                await catalog.remember_file_id(pid, msg.photo[-1].file_id)
+                uploaded += 1
+            try:
+                await msg.delete()
+            except Exception:
+                pass  # Не страшно, если сообщение останется в служебном чате
+        except Exception as e:
+            logger.error(f"Photo prewarm failed for product {pid}: {e}")
+        # Не упираемся в лимиты Telegram
+        await asyncio.sleep(delay)
+    return uploaded
@@ -0,0 +1,226 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 в секунду в один чат (с небольшим запасом на всплеск)
+RATE_GLOBAL_PER_SEC = float(os.getenv("RATE_GLOBAL_PER_SEC", "30"))
+RATE_GLOBAL_BURST = float(os.getenv("RATE_GLOBAL_BURST", "30"))
+RATE_CHAT_PER_SEC = float(os.getenv("RATE_CHAT_PER_SEC", "1"))
+RATE_CHAT_BURST = float(os.getenv("RATE_CHAT_BURST", "3"))
+# Сколько раз повторяем запрос после 429 и какую максимальную паузу готовы ждать
+RATE_MAX_RETRIES = int(os.getenv("RATE_MAX_RETRIES", "3"))
+RATE_MAX_RETRY_AFTER = float(os.getenv("RATE_MAX_RETRY_AFTER", "60"))
+# 429 из стольких разных чатов за окно (секунды) — значит, Telegram ограничил бота целиком, а не один чат
+RATE_FLOOD_CHATS = int(os.getenv("RATE_FLOOD_CHATS", "3"))
+RATE_FLOOD_WINDOW = float(os.getenv("RATE_FLOOD_WINDOW", "5"))
+# Сколько корзин чатов держим, прежде чем выбросить полностью восстановившиеся
+RATE_CHAT_BUCKETS = 10000
+
+# Приоритеты: ответы пользователю идут раньше фоновых рассылок (отчеты админу, прогрев фото)
+INTERACTIVE = 0
+BACKGROUND = 1
+
+send_priority: ContextVar[int] = ContextVar("send_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def background() -> Iterator[None]:
+    """Все запросы к Telegram внутри блока считаются фоновыми и пропускают интерактивные вперед."""
+    token = send_priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+class TokenBucket:
+    """Корзина токенов с резервированием: reserve() сразу забирает токен и говорит, сколько ждать."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds: float):
+        """Telegram попросил подождать (Retry-After) — до этого момента токенов нет."""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens = min(self.tokens, 0.0)
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Планировщик исходящих запросов к Telegram (middleware сессии бота).
+    Каждый запрос, адресованный чату, сначала ждет токен в корзине своего чата, затем — в общей корзине.
+    Общие токены раздает одна фоновая задача строго по приоритету: интерактивные ответы раньше фоновых.
+    На 429 чат блокируется на Retry-After, и запрос повторяется. Длинный Retry-After у одного чата — обычное дело
+    (флуд правками, лимит группы), поэтому общая корзина блокируется, только если 429 пришли из RATE_FLOOD_CHATS
+    разных чатов за RATE_FLOOD_WINDOW секунд, и не дольше RATE_MAX_RETRY_AFTER.
+    Запросы без chat_id (getUpdates, answerCallbackQuery, setWebhook...) идут без ограничений.
+    """
+
+    def __init__(self, global_rate: float = RATE_GLOBAL_PER_SEC, global_burst: float = RATE_GLOBAL_BURST,
+                 chat_rate: float = RATE_CHAT_PER_SEC, chat_burst: float = RATE_CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chats: Dict[object, TokenBucket] = {}
+        self._queue: "asyncio.PriorityQueue[Tuple[int, int, asyncio.Future]]" = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._waiting = [0, 0]
+        self._chat_waiting = 0
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.throttled = 0
+        self.retry_after_hits = 0
+        self.global_blocks = 0
+        # chat_id -> время последнего 429 (для определения ограничения всего бота)
+        self._flooded: Dict[object, float] = {}
+
+    # --------- Корзины ---------
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= RATE_CHAT_BUCKETS:
+                # Полная корзина ничем не отличается от новой — такие можно забыть
+                for key in [k for k, b in self._chats.items() if b.idle()]:
+                    del self._chats[key]
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    @staticmethod
+    async def _wait_bucket(bucket: TokenBucket, delay: float):
+        while delay > 0:
+            await asyncio.sleep(delay)
+            # Пока ждали, мог прийти Retry-After
+            delay = bucket.blocked_until - time.monotonic()
+
+    def _on_retry_after(self, chat_id, retry_after: float):
+        self.retry_after_hits += 1
+        self._chat_bucket(chat_id).block(retry_after)
+        now = time.monotonic()
+        self._flooded[chat_id] = now
+        for key in [k for k, t in self._flooded.items() if now - t > RATE_FLOOD_WINDOW]:
+            del self._flooded[key]
+        if len(self._flooded) >= RATE_FLOOD_CHATS:
+            # 429 сразу из нескольких чатов — Telegram притормозил бота целиком
+            self.global_blocks += 1
+            self.global_bucket.block(min(retry_after, RATE_MAX_RETRY_AFTER))
+
+    # --------- Раздача общих токенов ---------
+    async def _run(self):
+        while True:
+            priority, _, fut = await self._queue.get()
+            self._waiting[priority] -= 1
+            if fut.done():
+                # Ожидающий отменился — токен не тратим
+                continue
+            await self._wait_bucket(self.global_bucket, self.global_bucket.reserve())
+            if not fut.done():
+                fut.set_result(None)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Кто еще ждал — отпускаем, чтобы остановка не зависла
+        while not self._queue.empty():
+            priority, _, fut = self._queue.get_nowait()
+            self._waiting[priority] -= 1
+            if not fut.done():
+                fut.set_result(None)
+        logger.info(f"Send scheduler stats: {self.stats()}")
+
+    async def acquire(self, chat_id, priority: int = INTERACTIVE):
+        chat_bucket = self._chat_bucket(chat_id)
+        delay = chat_bucket.reserve()
+        if delay > 0:
+            self.throttled += 1
+            self._chat_waiting += 1
+            try:
+                await self._wait_bucket(chat_bucket, delay)
+            finally:
+                self._chat_waiting -= 1
+
+        if self._task is None:
+            self.start()
+        fut = asyncio.get_running_loop().create_future()
+        self._waiting[priority] += 1
+        self._queue.put_nowait((priority, next(self._seq), fut))
+        await fut
+
+    def stats(self) -> Dict[str, int]:
+        """Глубина очередей и счетчики (для логов и метрик)."""
+        return {
+            "queue_interactive": self._waiting[INTERACTIVE],
+            "queue_background": self._waiting[BACKGROUND],
+            "waiting_per_chat": self._chat_waiting,
+            "chats_tracked": len(self._chats),
+            "sent": self.sent,
+            "throttled": self.throttled,
+            "retry_after": self.retry_after_hits,
+            "global_blocks": self.global_blocks,
+        }
+
+    # --------- Middleware ---------
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot: Bot,
+                       method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        priority = send_priority.get()
+        attempt = 0
+        while True:
+            await self.acquire(chat_id, priority)
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self._on_retry_after(chat_id, e.retry_after)
+                attempt += 1
+                if attempt > RATE_MAX_RETRIES or e.retry_after > RATE_MAX_RETRY_AFTER:
+                    raise
+                logger.warning(f"{type(method).__name__} to {chat_id}: retry after {e.retry_after}s")
+                continue
+            self.sent += 1
+            return response
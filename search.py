@@ -0,0 +1,82 @@
+import os
+import re
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from catalog import CATALOG_TYPES, Catalog, Product
+from database import Database
+
+# Сколько результатов отдаем на один inline-запрос (Telegram принимает до 50) и сколько запросов держим в кэше
+SEARCH_LIMIT = int(os.getenv("SEARCH_LIMIT", "20"))
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1000"))
+# Больше слов в запросе не учитываем
+SEARCH_MAX_TERMS = 5
+
+_TYPES = ", ".join(f"'{t}'" for t in CATALOG_TYPES)
+_INDEXED = f"type IN ({_TYPES})"
+
+# Схема индекса products_fts и триггеры синхронизации — в migrations.py (шаг «product search»)
+SEARCH_SQL = f"""
+SELECT p.id FROM products_fts f JOIN products p ON p.id = f.rowid
+WHERE products_fts MATCH ? AND p.{_INDEXED}
+ORDER BY rank LIMIT ?
+"""
+
+
+def match_expression(query: str) -> Optional[str]:
+    """«белые роз» -> '"белые"* "роз"*' (каждое слово — префикс, все слова обязательны). None — искать нечего."""
+    terms = re.findall(r"\w+", query.lower())[:SEARCH_MAX_TERMS]
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+class CatalogSearch:
+    """
+    Поиск по каталогу для inline-режима.
+    Ищет по FTS5-индексу, а сами товары берет из кэша каталога. Результат кэшируется по нормализованному
+    запросу: inline-запросы приходят на каждое нажатие клавиши («р», «ро», «роз»), и у каждого префикса своя запись.
+    Кэш привязан к версии каталога — после правки товаров он сбрасывается целиком.
+    """
+
+    def __init__(self, db: Database, catalog: Catalog, limit: int = SEARCH_LIMIT, max_entries: int = SEARCH_CACHE_SIZE):
+        self.db = db
+        self.catalog = catalog
+        self.limit = limit
+        self.max_entries = max_entries
+        self.version: Optional[int] = None
+        self._cache: "OrderedDict[Optional[str], Tuple[int, ...]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def search(self, query: str) -> List[Product]:
+        expression = match_expression(query)
+        version = self.catalog.version
+        if version != self.version:
+            self._cache.clear()
+            self.version = version
+
+        ids = self._cache.get(expression)
+        if ids is not None:
+            self.hits += 1
+            self._cache.move_to_end(expression)
+        else:
+            self.misses += 1
+            if expression is None:
+                # Пустой запрос — показываем букеты витрины
+                ids = tuple(p[0] for p in (await self.catalog.products("bouquet"))[:self.limit])
+            else:
+                rows = await self.db.fetchall(SEARCH_SQL, (expression, self.limit))
+                ids = tuple(row[0] for row in rows)
+            # Если каталог поменяли, пока шел запрос, — результат не кэшируем
+            if version == self.catalog.version:
+                self._cache[expression] = ids
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+
+        products = []
+        for pid in ids:
+            product = await self.catalog.get(pid)
+            if product:
+                products.append(product)
+        return products
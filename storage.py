@@ -0,0 +1,170 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Сколько сессий держим в памяти и через сколько секунд бездействия сессия истекает
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_SESSION_TTL = float(os.getenv("FSM_SESSION_TTL", str(7 * 24 * 3600)))
+FSM_SWEEP_INTERVAL = float(os.getenv("FSM_SWEEP_INTERVAL", "3600"))
+
+# (state, data, updated_at)
+Record = Tuple[Optional[str], Dict[str, Any], float]
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM в таблице fsm_storage той же базы магазина.
+    Перед базой стоит LRU-кэш: чтения активных пользователей не ходят в SQLite,
+    а каждая запись сразу уходит и в кэш, и в базу (write-through) — рестарт ничего не теряет.
+    Сессии без изменений дольше ttl считаются пустыми и периодически вычищаются.
+    """
+
+    def __init__(self, db: Database, cache_size: int = FSM_CACHE_SIZE, ttl: float = FSM_SESSION_TTL,
+                 sweep_interval: float = FSM_SWEEP_INTERVAL):
+        self.db = db
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self._cache: "OrderedDict[str, Record]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+
+    # --------- Кэш ---------
+    def _remember(self, k: str, record: Record):
+        self._cache[k] = record
+        self._cache.move_to_end(k)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, k: str) -> Record:
+        now = time.time()
+        record = self._cache.get(k)
+        if record is not None and now - record[2] <= self.ttl:
+            self.hits += 1
+            self._cache.move_to_end(k)
+            return record
+
+        self.misses += 1
+        row = await self.db.fetchone("SELECT state, data, updated_at FROM fsm_storage WHERE key = ?", (k,))
+        if row and now - row[2] <= self.ttl:
+            record = (row[0], json.loads(row[1]), row[2])
+        else:
+            record = (None, {}, now)
+        self._remember(k, record)
+        return record
+
+    async def _save(self, k: str, state: Optional[str], data: Dict[str, Any]):
+        now = time.time()
+        current = self._cache.get(k)
+        if current is not None and current[0] == state and current[1] == data:
+            # Ничего не меняется (например, state.clear() на пустой сессии в /start) — писатель не трогаем.
+            # Непустую сессию изредка все же переписываем, чтобы активный пользователь не истек по ttl
+            if (state is None and not data) or now - current[2] < self.ttl / 2:
+                self._cache.move_to_end(k)
+                return
+        self._remember(k, (state, data, now))
+        if state is None and not data:
+            # Пустая сессия — строка не нужна
+            await self.db.execute("DELETE FROM fsm_storage WHERE key = ?", (k,))
+        else:
+            await self.db.execute("""
+                INSERT INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data,
+                                               updated_at = excluded.updated_at
+            """, (k, state, json.dumps(data, ensure_ascii=False), now))
+
+    # --------- BaseStorage ---------
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self.key_builder.build(key)
+        _, data, _ = await self._load(k)
+        await self._save(k, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        k = self.key_builder.build(key)
+        state, _, _ = await self._load(k)
+        await self._save(k, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data, _ = await self._load(self.key_builder.build(key))
+        return data.copy()
+
+    async def close(self) -> None:
+        # Соединениями владеет Database — здесь только останавливаем чистку
+        await self.stop()
+
+    # --------- Чистка истекших сессий ---------
+    async def sweep(self) -> int:
+        deadline = time.time() - self.ttl
+        removed = await self.db.execute("DELETE FROM fsm_storage WHERE updated_at < ?", (deadline,))
+        for k in [k for k, record in self._cache.items() if record[2] < deadline]:
+            del self._cache[k]
+        if removed:
+            logger.info(f"FSM sweep: {removed} expired sessions removed")
+        return removed
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"FSM sweep error: {e}")
+            await asyncio.sleep(self.sweep_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class SessionStore:
+    """
+    Данные пользователя вне сценариев FSM (editing_pid и т.п., бывший словарь user_states).
+    Живут в том же хранилище под отдельным destiny, поэтому state.clear() их не трогает.
+    """
+
+    DESTINY = "session"
+
+    def __init__(self, storage: BaseStorage, bot_id: int):
+        self.storage = storage
+        self.bot_id = bot_id
+
+    def _key(self, user_id: int) -> StorageKey:
+        return StorageKey(bot_id=self.bot_id, chat_id=user_id, user_id=user_id, destiny=self.DESTINY)
+
+    async def get(self, user_id: int) -> Dict[str, Any]:
+        return await self.storage.get_data(self._key(user_id))
+
+    async def update(self, user_id: int, **values: Any):
+        await self.storage.update_data(self._key(user_id), values)
+
+    async def discard(self, user_id: int, *names: str):
+        data = await self.get(user_id)
+        if any(name in data for name in names):
+            for name in names:
+                data.pop(name, None)
+            await self.storage.set_data(self._key(user_id), data)
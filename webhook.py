@@ -0,0 +1,140 @@
+import asyncio
+import hmac
+import logging
+import os
+from typing import List, Optional
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+# Публичный адрес, на который Telegram будет слать обновления (https://bot.example.com)
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Сколько обновлений обрабатываем одновременно и сколько держим в очереди
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "32"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "10"))
+
+
+class WebhookServer:
+    """
+    Прием обновлений через webhook на aiohttp.
+    HTTP-обработчик только проверяет секрет и кладет обновление в очередь (сразу отвечает 200),
+    а фиксированное число воркеров прогоняет очередь через dp.feed_update.
+    /healthz — процесс жив, /readyz — готов принимать трафик (для балансировщика).
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, base_url: Optional[str] = WEBHOOK_BASE_URL,
+                 path: str = WEBHOOK_PATH, secret: Optional[str] = WEBHOOK_SECRET,
+                 host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT,
+                 workers: int = WEBHOOK_WORKERS, queue_size: int = WEBHOOK_QUEUE_SIZE):
+        self.dp = dp
+        self.bot = bot
+        self.base_url = base_url
+        self.path = path
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.workers_count = workers
+        self.queue: "asyncio.Queue[Update]" = asyncio.Queue(maxsize=queue_size)
+        self._workers: List[asyncio.Task] = []
+        self._runner: Optional[web.AppRunner] = None
+        self._ready = False
+        self.received = 0
+        self.rejected = 0
+
+    # --------- HTTP ---------
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret:
+            token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(token, self.secret):
+                return web.Response(status=401)
+
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logger.warning(f"Bad webhook payload: {e}")
+            return web.Response(status=400)
+
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Очередь переполнена — Telegram повторит доставку позже
+            self.rejected += 1
+            return web.Response(status=503)
+        self.received += 1
+        return web.Response(status=200)
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    async def ready(self, request: web.Request) -> web.Response:
+        if self._ready and not self.queue.full():
+            return web.Response(text="ready")
+        return web.Response(status=503, text="not ready")
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/healthz", self.health)
+        app.router.add_get("/readyz", self.ready)
+        return app
+
+    # --------- Обработка ---------
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.exception(f"Update {update.update_id} failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self, app: Optional[web.Application] = None):
+        for _ in range(self.workers_count):
+            self._workers.append(asyncio.create_task(self._worker()))
+
+        self._runner = web.AppRunner(app or self.build_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+        if self.base_url:
+            await self.bot.set_webhook(
+                url=self.base_url.rstrip("/") + self.path,
+                secret_token=self.secret,
+                allowed_updates=self.dp.resolve_used_update_types(),
+            )
+        else:
+            logger.warning("WEBHOOK_BASE_URL is not set — webhook is not registered in Telegram")
+        self._ready = True
+        logger.info(f"Webhook server listening on {self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        # Сначала перестаем считаться готовыми, чтобы балансировщик увел трафик
+        self._ready = False
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=WEBHOOK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Webhook stop: {self.queue.qsize()} updates left unprocessed")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def run(self):
+        """Запускает сервер и работает до отмены (Ctrl+C / SIGTERM)."""
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()